@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+# Request priorities, lower values are admitted first
+PRIORITY_ADMIN = 0
+PRIORITY_PRIVATE = 1
+PRIORITY_GROUP = 2
+PRIORITY_BACKGROUND = 3
+
+
+class AdmissionController:
+    """
+    Admits requests to the OpenAI API so that at most a maximum number of them are in flight
+    and their estimated token usage stays within a tokens-per-minute budget, enforced with a
+    token bucket. Waiting requests are admitted by priority, then in arrival order.
+    """
+
+    def __init__(self, max_in_flight: int, tokens_per_minute: int):
+        """
+        :param max_in_flight: Maximum number of requests in flight, or 0 for no limit
+        :param tokens_per_minute: Maximum estimated number of tokens per minute, or 0 for no limit
+        """
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        self.tokens = float(tokens_per_minute)
+        self.refilled_at = time.monotonic()
+        self.waiters: list[list] = []  # heap of [priority, arrival, tokens, future]
+        self.arrivals = itertools.count()
+        self.wakeup: asyncio.TimerHandle | None = None
+
+    @asynccontextmanager
+    async def admit(self, tokens: int, priority: int):
+        """
+        Waits until the request can be admitted and keeps it in flight for the duration of the block.
+        :param tokens: The estimated number of tokens of the request (prompt and completion)
+        :param priority: The priority of the request
+        """
+        await self.acquire(tokens, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, tokens: int, priority: int):
+        """
+        Waits until the request can be admitted. Must be followed by a call to release().
+        :param tokens: The estimated number of tokens of the request (prompt and completion)
+        :param priority: The priority of the request
+        """
+        # A request larger than the whole budget is admitted once the bucket is full
+        tokens = min(tokens, self.tokens_per_minute)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, [priority, next(self.arrivals), tokens, future])
+        self.__dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted right before being cancelled
+                self.release()
+            raise
+
+    def release(self):
+        """
+        Marks an admitted request as finished.
+        """
+        self.in_flight -= 1
+        self.__dispatch()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens_per_minute,
+                          self.tokens + (now - self.refilled_at) * self.tokens_per_minute / 60)
+        self.refilled_at = now
+
+    def __dispatch(self):
+        """
+        Admits the waiting requests that fit in the limits, in priority order.
+        """
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+            self.wakeup = None
+        if self.tokens_per_minute > 0:
+            self.__refill()
+
+        while self.waiters and (self.max_in_flight <= 0 or self.in_flight < self.max_in_flight):
+            _, _, tokens, future = self.waiters[0]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(self.waiters)
+                continue
+            if self.tokens_per_minute > 0 and tokens > self.tokens:
+                delay = (tokens - self.tokens) * 60 / self.tokens_per_minute
+                self.wakeup = asyncio.get_running_loop().call_later(delay, self.__dispatch)
+                return
+            heapq.heappop(self.waiters)
+            self.tokens -= tokens
+            self.in_flight += 1
+            future.set_result(None)
+
+
+class AdmittedStream:
+    """
+    Wraps the response stream of an admitted request, so that the request stays in flight
+    until the stream is exhausted, fails or is closed, rather than until it starts.
+    """
+
+    def __init__(self, stream, release):
+        """
+        :param stream: The response stream, an async iterator with an async close() method
+        :param release: The function to call once, when the request is finished
+        """
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            self.__release()
+            raise
+        except BaseException:
+            await self.close()
+            raise
+
+    async def close(self):
+        self.__release()
+        await self.stream.close()
+
+    def __release(self):
+        if not self.released:
+            self.released = True
+            self.release()
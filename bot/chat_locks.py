@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class ChatLocks:
+    """
+    Per-chat locks that let updates of the same chat run one at a time, in the order they arrived,
+    while updates of different chats run in parallel. A chat only has an entry while it has
+    updates running or waiting, so the lock table never grows beyond the number of busy chats.
+    """
+
+    def __init__(self):
+        self.locks: dict[int, asyncio.Lock] = {}
+        self.depths: dict[int, int] = {}  # {chat_id: number of updates running or waiting}
+
+    @asynccontextmanager
+    async def hold(self, chat_id: int):
+        """
+        Waits for the previous updates of the chat to finish and holds its lock for the duration of the block.
+        :param chat_id: The chat ID
+        """
+        lock = self.locks.setdefault(chat_id, asyncio.Lock())
+        self.depths[chat_id] = self.depths.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.depths[chat_id] -= 1
+            if self.depths[chat_id] == 0:
+                del self.depths[chat_id]
+                del self.locks[chat_id]
+
+    def queue_depth(self, chat_id: int) -> int:
+        """
+        Gets the number of updates of the chat that are running or waiting.
+        :param chat_id: The chat ID
+        :return: The queue depth of the chat
+        """
+        return self.depths.get(chat_id, 0)
+
+    def queue_depths(self) -> dict[int, int]:
+        """
+        Gets the queue depth of every chat that has updates running or waiting.
+        :return: A dictionary of chat IDs to queue depths
+        """
+        return dict(self.depths)
@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import datetime
+import json
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+# Seconds to wait for another process writing to a shared database, e.g. another worker
+SHARED_DB_TIMEOUT = 60
+
+
+def message_size(message: dict) -> int:
+    """
+    Estimates the number of bytes a message takes in memory, based on its JSON representation.
+    :param message: The message
+    :return: The estimated size in bytes
+    """
+    return len(json.dumps(message))
+
+
+class Conversation:
+    """
+    The conversation state of a single chat: its message history, the number of tokens
+    of each message, whether it uses the vision model and when it was last updated.
+    """
+
+    def __init__(self, messages: list = None, message_tokens: list = None, is_vision: bool = False,
+                 last_updated: datetime.datetime = None):
+        self.messages: list = []
+        self.message_tokens: list[int] = []
+        self.tokens = 0
+        self.size = 0
+        self.is_vision = is_vision
+        self.last_updated = last_updated
+        self.replace(messages or [], message_tokens or [])
+
+    def append(self, message: dict, tokens: int):
+        """
+        Appends a message to the history.
+        :param message: The message to append
+        :param tokens: The number of tokens of the message
+        """
+        self.messages.append(message)
+        self.message_tokens.append(tokens)
+        self.tokens += tokens
+        self.size += message_size(message)
+
+    def replace(self, messages: list, message_tokens: list):
+        """
+        Replaces the whole history.
+        :param messages: The new messages
+        :param message_tokens: The number of tokens of each new message
+        """
+        self.messages = messages
+        self.message_tokens = message_tokens
+        self.tokens = sum(message_tokens)
+        self.size = sum(message_size(message) for message in messages)
+
+    def to_dict(self) -> dict:
+        return {
+            'messages': self.messages,
+            'message_tokens': self.message_tokens,
+            'is_vision': self.is_vision,
+            'last_updated': self.last_updated.isoformat() if self.last_updated else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Conversation:
+        last_updated = data.get('last_updated')
+        return cls(messages=data['messages'], message_tokens=data['message_tokens'], is_vision=data['is_vision'],
+                   last_updated=datetime.datetime.fromisoformat(last_updated) if last_updated else None)
+
+
+class ConversationStore(ABC):
+    """
+    A store interface for the conversations of all chats, keyed by chat ID.
+    """
+
+    @abstractmethod
+    def get(self, chat_id: int) -> Conversation | None:
+        """
+        Return the conversation of the given chat, or None if there is none.
+        """
+        pass
+
+    @abstractmethod
+    def put(self, chat_id: int, conversation: Conversation):
+        """
+        Store the conversation of the given chat. Must be called again after the conversation is modified.
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, chat_id: int):
+        """
+        Remove the conversation of the given chat, if any.
+        """
+        pass
+
+    @abstractmethod
+    def delete_expired(self, before: datetime.datetime) -> tuple[int, int]:
+        """
+        Remove the conversations last updated before the given time.
+        :return: The number of conversations removed and the estimated number of bytes reclaimed
+        """
+        pass
+
+    def pin(self, chat_id: int):
+        """
+        Keep the conversation of the given chat in the store while a request for it is in flight.
+        Can be nested, the conversation is kept until unpin() has been called as many times.
+        """
+        pass
+
+    def unpin(self, chat_id: int):
+        """
+        Release a pin taken by pin().
+        """
+        pass
+
+    def close(self):
+        """
+        Persist any pending state and release resources.
+        """
+        pass
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Keeps conversations in memory, evicting the least recently used ones once
+    the maximum number of conversations or the maximum total size is exceeded.
+    The conversations of the chats with a request in flight are never evicted.
+    """
+
+    def __init__(self, max_conversations: int, max_bytes: int):
+        """
+        :param max_conversations: Maximum number of conversations to keep in memory
+        :param max_bytes: Maximum estimated total size in bytes of the conversations kept in memory
+        """
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.conversations: OrderedDict[int, Conversation] = OrderedDict()
+        self.sizes: dict[int, int] = {}  # {chat_id: size at the time it was stored}
+        self.total_size = 0
+        self.pinned: dict[int, int] = {}  # {chat_id: number of requests in flight}
+
+    def get(self, chat_id: int) -> Conversation | None:
+        conversation = self.conversations.get(chat_id)
+        if conversation is not None:
+            self.conversations.move_to_end(chat_id)
+        return conversation
+
+    def put(self, chat_id: int, conversation: Conversation):
+        self.total_size -= self.sizes.get(chat_id, 0)
+        self.conversations[chat_id] = conversation
+        self.conversations.move_to_end(chat_id)
+        self.sizes[chat_id] = conversation.size
+        self.total_size += conversation.size
+        self._evict()
+
+    def delete(self, chat_id: int):
+        if chat_id in self.conversations:
+            del self.conversations[chat_id]
+            self.total_size -= self.sizes.pop(chat_id)
+
+    def delete_expired(self, before: datetime.datetime) -> tuple[int, int]:
+        expired = [chat_id for chat_id, conversation in self.conversations.items()
+                   if conversation.last_updated is not None and conversation.last_updated < before
+                   and chat_id not in self.pinned]
+        reclaimed = sum(self.sizes[chat_id] for chat_id in expired)
+        for chat_id in expired:
+            InMemoryConversationStore.delete(self, chat_id)
+        return len(expired), reclaimed
+
+    def pin(self, chat_id: int):
+        self.pinned[chat_id] = self.pinned.get(chat_id, 0) + 1
+
+    def unpin(self, chat_id: int):
+        self.pinned[chat_id] -= 1
+        if self.pinned[chat_id] == 0:
+            del self.pinned[chat_id]
+            self._evict()
+
+    def _is_over_limits(self) -> bool:
+        return len(self.conversations) > self.max_conversations or self.total_size > self.max_bytes
+
+    def _evict(self):
+        """
+        Evicts the least recently used conversations until the limits are respected.
+        The most recently used and the pinned conversations are never evicted,
+        so the limits can be exceeded while they are in flight.
+        """
+        if not self._is_over_limits():
+            return
+        for chat_id in list(self.conversations)[:-1]:
+            if not self._is_over_limits():
+                break
+            if chat_id in self.pinned:
+                continue
+            conversation = self.conversations.pop(chat_id)
+            self.total_size -= self.sizes.pop(chat_id)
+            logging.debug(f'Evicting conversation for chat ID {chat_id} from memory')
+            self._on_evict(chat_id, conversation)
+
+    def _on_evict(self, chat_id: int, conversation: Conversation):
+        """
+        Called when a conversation is evicted from memory. Evicted conversations are dropped.
+        """
+        pass
+
+
+class SQLiteConversationStore(InMemoryConversationStore):
+    """
+    Keeps recently used conversations in memory and spills the others to a SQLite database,
+    from which they are loaded back on access. Conversations still in memory are written
+    to the database when the store is closed, so they survive restarts.
+    """
+
+    def __init__(self, path: str, max_conversations: int, max_bytes: int, shared: bool = False):
+        """
+        :param path: Path to the SQLite database file
+        :param max_conversations: Maximum number of conversations to keep in memory
+        :param max_bytes: Maximum estimated total size in bytes of the conversations kept in memory
+        :param shared: Whether other processes use the same database, e.g. the other workers
+        """
+        super().__init__(max_conversations, max_bytes)
+        if shared:
+            # Let readers and a writer of other processes work at the same time, and wait for the other writers
+            self.db = sqlite3.connect(path, timeout=SHARED_DB_TIMEOUT)
+            self.db.execute('PRAGMA journal_mode=WAL')
+        else:
+            self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS conversations '
+                        '(chat_id INTEGER PRIMARY KEY, last_updated TEXT, data TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS conversations_last_updated ON conversations (last_updated)')
+        self.db.commit()
+
+    def get(self, chat_id: int) -> Conversation | None:
+        conversation = super().get(chat_id)
+        if conversation is None:
+            row = self.db.execute('SELECT data FROM conversations WHERE chat_id = ?', (chat_id,)).fetchone()
+            if row is not None:
+                conversation = Conversation.from_dict(json.loads(row[0]))
+                super().put(chat_id, conversation)
+        return conversation
+
+    def delete(self, chat_id: int):
+        super().delete(chat_id)
+        self.db.execute('DELETE FROM conversations WHERE chat_id = ?', (chat_id,))
+        self.db.commit()
+
+    def delete_expired(self, before: datetime.datetime) -> tuple[int, int]:
+        rows = self.db.execute('SELECT chat_id, LENGTH(data) FROM conversations WHERE last_updated < ?',
+                               (before.isoformat(),)).fetchall()
+        # Rows of conversations that are also in memory are stale copies, only count the spilled ones
+        spilled = [size for chat_id, size in rows if chat_id not in self.conversations]
+        count, reclaimed = super().delete_expired(before)
+        self.db.execute('DELETE FROM conversations WHERE last_updated < ?', (before.isoformat(),))
+        self.db.commit()
+        return count + len(spilled), reclaimed + sum(spilled)
+
+    def _on_evict(self, chat_id: int, conversation: Conversation):
+        self._write(chat_id, conversation)
+        self.db.commit()
+
+    def _write(self, chat_id: int, conversation: Conversation):
+        last_updated = conversation.last_updated.isoformat() if conversation.last_updated else None
+        self.db.execute('INSERT OR REPLACE INTO conversations (chat_id, last_updated, data) VALUES (?, ?, ?)',
+                        (chat_id, last_updated, json.dumps(conversation.to_dict())))
+
+    def close(self):
+        for chat_id, conversation in self.conversations.items():
+            self._write(chat_id, conversation)
+        self.db.commit()
+        self.db.close()
+
+
+def create_conversation_store(config: dict) -> ConversationStore:
+    """
+    Creates the conversation store described by the given configuration.
+    :param config: A dictionary containing the GPT configuration
+    :return: The conversation store
+    """
+    max_conversations = config['max_conversations_in_memory']
+    max_bytes = config['max_conversations_memory_mb'] * 1024 * 1024
+    if config['conversation_store'] == 'sqlite':
+        return SQLiteConversationStore(config['conversation_db_path'], max_conversations, max_bytes,
+                                       shared=config.get('workers', 1) > 1)
+    return InMemoryConversationStore(max_conversations, max_bytes)
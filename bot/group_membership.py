@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Iterable
+
+from telegram import ChatMember, ChatMemberUpdated
+
+MEMBER_STATUSES = (ChatMember.OWNER, ChatMember.ADMINISTRATOR, ChatMember.MEMBER)
+
+
+class GroupMembershipCache:
+    """
+    Remembers for a while whether users are members of group chats, so that authorizing a group
+    message does not query the Bot API for every allowed user. Unknown memberships are looked up
+    concurrently, and the cache is kept up to date by the chat member updates the bot receives.
+    """
+
+    def __init__(self, ttl: float):
+        """
+        :param ttl: The number of seconds a membership is remembered, or 0 to always look it up
+        """
+        self.ttl = ttl
+        self.memberships: dict[tuple[int, str], tuple[bool, float]] = {}  # {(chat_id, user_id): (member, expires at)}
+
+    def get(self, chat_id: int, user_id) -> bool | None:
+        """
+        Gets whether the user is a member of the chat.
+        :return: The cached membership, or None if it is unknown or expired
+        """
+        cached = self.memberships.get((chat_id, str(user_id)))
+        if cached is None or cached[1] < time.monotonic():
+            return None
+        return cached[0]
+
+    def set(self, chat_id: int, user_id, is_member: bool):
+        if self.ttl > 0:
+            self.memberships[(chat_id, str(user_id))] = (is_member, time.monotonic() + self.ttl)
+
+    async def find_member(self, chat_id: int, user_ids: Iterable,
+                          lookup: Callable[[str], Awaitable[bool]]) -> str | None:
+        """
+        Finds one of the given users that is a member of the chat. The memberships that are not cached
+        are looked up concurrently, and the remaining lookups are cancelled as soon as a member is found.
+        :param chat_id: The chat ID
+        :param user_ids: The IDs of the users to look for
+        :param lookup: A function looking up whether a user is a member of the chat
+        :return: The ID of a user that is a member, or None if there is none
+        """
+        unknown = []
+        for user_id in user_ids:
+            is_member = self.get(chat_id, user_id)
+            if is_member:
+                return user_id
+            if is_member is None:
+                unknown.append(user_id)
+        if not unknown:
+            return None
+
+        async def check(user_id):
+            is_member = await lookup(user_id)
+            self.set(chat_id, user_id, is_member)
+            return is_member
+
+        tasks = {asyncio.create_task(check(user_id)): user_id for user_id in unknown}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logging.warning(f'Failed to check if {tasks[task]} is a member of chat {chat_id}: '
+                                        f'{str(task.exception())}')
+                    elif task.result():
+                        return tasks[task]
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def on_chat_member_updated(self, chat_member_updated: ChatMemberUpdated):
+        """
+        Updates the cached membership of a user who joined or left a chat.
+        """
+        new_member = chat_member_updated.new_chat_member
+        self.set(chat_member_updated.chat.id, new_member.user.id, new_member.status in MEMBER_STATUSES)
+
+    def forget_chat(self, chat_id: int):
+        """
+        Forgets the memberships of a chat, e.g. when the bot left it.
+        """
+        for key in [key for key in self.memberships if key[0] == chat_id]:
+            del self.memberships[key]
+
+    def prune(self) -> int:
+        """
+        Removes the expired memberships.
+        :return: The number of memberships removed
+        """
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self.memberships.items() if expires_at < now]
+        for key in expired:
+            del self.memberships[key]
+        return len(expired)
@@ -1,11 +1,16 @@
+import functools
 import logging
 import os
 
 from dotenv import load_dotenv
 
+from conversation_store import create_conversation_store
 from plugin_manager import PluginManager
-from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available
+from openai_helper import OpenAIHelper, default_max_tokens, are_functions_available, preload_encodings
+from sharding import run_sharded, worker_configs
 from telegram_bot import ChatGPTTelegramBot
+from usage_tracker import backfill_all_time_costs
+from utils import parse_user_lists, setup_logging
 
 
 def main():
@@ -13,11 +18,7 @@ def main():
     load_dotenv()
 
     # Setup logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
-    logging.getLogger("httpx").setLevel(logging.WARNING)
+    setup_logging()
 
     # Check if the required environment variables are set
     required_values = ['TELEGRAM_BOT_TOKEN', 'OPENAI_API_KEY']
@@ -37,6 +38,13 @@ def main():
         'proxy': os.environ.get('PROXY', None) or os.environ.get('OPENAI_PROXY', None),
         'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
         'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'enable_background_summarisation': os.environ.get('ENABLE_BACKGROUND_SUMMARISATION', 'false').lower() == 'true',
+        'background_summarisation_margin': float(os.environ.get('BACKGROUND_SUMMARISATION_MARGIN', 0.2)),
+        'history_strategy': os.environ.get('HISTORY_STRATEGY', 'summarise').lower(),
+        'conversation_store': os.environ.get('CONVERSATION_STORE', 'memory').lower(),
+        'conversation_db_path': os.environ.get('CONVERSATION_DB_PATH', 'conversations.db'),
+        'max_conversations_in_memory': int(os.environ.get('MAX_CONVERSATIONS_IN_MEMORY', 10000)),
+        'max_conversations_memory_mb': int(os.environ.get('MAX_CONVERSATIONS_MEMORY_MB', 512)),
         'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are a helpful assistant.'),
         'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
         'n_choices': int(os.environ.get('N_CHOICES', 1)),
@@ -63,12 +71,25 @@ def main():
         'enable_functions': os.environ.get('ENABLE_FUNCTIONS', str(functions_available)).lower() == 'true',
         'enable_natural_language_plugin_routing': os.environ.get('ENABLE_NATURAL_LANGUAGE_PLUGIN_ROUTING', 'true').lower() == 'true',
         'functions_max_consecutive_calls': int(os.environ.get('FUNCTIONS_MAX_CONSECUTIVE_CALLS', 10)),
+        'admin_user_ids': os.environ.get('ADMIN_USER_IDS', '-'),
+        'max_concurrent_requests': int(os.environ.get('MAX_CONCURRENT_REQUESTS', 10)),
+        'tokens_per_minute': int(os.environ.get('TOKENS_PER_MINUTE', 0)),
+        'openai_max_retries': int(os.environ.get('OPENAI_MAX_RETRIES', 3)),
+        'openai_max_retry_wait': float(os.environ.get('OPENAI_MAX_RETRY_WAIT', 60)),
     }
 
     if openai_config['enable_functions'] and not functions_available:
         logging.error(f'ENABLE_FUNCTIONS is set to true, but the model {model} does not support it. '
                         'Please set ENABLE_FUNCTIONS to false or use a model that supports it.')
         exit(1)
+    if openai_config['history_strategy'] not in ('summarise', 'window', 'hybrid'):
+        logging.error(f'HISTORY_STRATEGY must be one of summarise, window or hybrid, '
+                      f'got {openai_config["history_strategy"]}')
+        exit(1)
+    if openai_config['conversation_store'] not in ('memory', 'sqlite'):
+        logging.error(f'CONVERSATION_STORE must be either memory or sqlite, '
+                      f'got {openai_config["conversation_store"]}')
+        exit(1)
     if os.environ.get('MONTHLY_USER_BUDGETS') is not None:
         logging.warning('The environment variable MONTHLY_USER_BUDGETS is deprecated. '
                         'Please use USER_BUDGETS with BUDGET_PERIOD instead.')
@@ -103,8 +124,43 @@ def main():
         'tts_prices': [float(i) for i in os.environ.get('TTS_PRICES', "0.015,0.030").split(",")],
         'transcription_price': float(os.environ.get('TRANSCRIPTION_PRICE', 0.006)),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
+        'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
+        'inline_query_ttl_minutes': int(os.environ.get('INLINE_QUERY_TTL_MINUTES', 60)),
+        'sweep_interval_minutes': int(os.environ.get('SWEEP_INTERVAL_MINUTES', 10)),
+        'plugin_check_interval_seconds': float(os.environ.get('PLUGIN_CHECK_INTERVAL_SECONDS', 60)),
+        'usage_flush_interval_seconds': float(os.environ.get('USAGE_FLUSH_INTERVAL_SECONDS', 5)),
+        'usage_store': os.environ.get('USAGE_STORE', 'json').lower(),
+        'usage_db_path': os.environ.get('USAGE_DB_PATH', 'usage.db'),
+        'access_cache_ttl_seconds': float(os.environ.get('ACCESS_CACHE_TTL_SECONDS', 30)),
+        'group_membership_ttl_minutes': float(os.environ.get('GROUP_MEMBERSHIP_TTL_MINUTES', 10)),
+        'stream_edit_interval': float(os.environ.get('STREAM_EDIT_INTERVAL', 1.0)),
+        'stream_group_edit_interval': float(os.environ.get('STREAM_GROUP_EDIT_INTERVAL', 3.0)),
+        'telegram_rate_limit': float(os.environ.get('TELEGRAM_RATE_LIMIT', 30)),
+        'telegram_group_rate_limit': float(os.environ.get('TELEGRAM_GROUP_RATE_LIMIT', 20)),
+        'webhook_url': os.environ.get('WEBHOOK_URL', ''),
+        'webhook_listen': os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+        'webhook_port': int(os.environ.get('WEBHOOK_PORT', 8443)),
+        'webhook_path': os.environ.get('WEBHOOK_PATH', 'webhook'),
+        'webhook_secret_token': os.environ.get('WEBHOOK_SECRET_TOKEN', ''),
+        'webhook_max_connections': int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40)),
+        'workers': int(os.environ.get('WORKERS', 1)),
     }
 
+    # Parse the user lists once, so that access and budget checks are set and dict lookups
+    telegram_config.update(parse_user_lists(telegram_config))
+    openai_config['admin_user_id_set'] = telegram_config['admin_user_id_set']
+
+    if telegram_config['usage_store'] not in ('json', 'sqlite'):
+        logging.error(f'USAGE_STORE must be either json or sqlite, got {telegram_config["usage_store"]}')
+        exit(1)
+    if telegram_config['usage_flush_interval_seconds'] <= 0:
+        logging.error('USAGE_FLUSH_INTERVAL_SECONDS must be greater than 0')
+        exit(1)
+    if telegram_config['workers'] > 1 and telegram_config['usage_store'] != 'sqlite':
+        # Each worker would keep its own copy of the usage logs, and overwrite the usage of the others
+        logging.error('WORKERS greater than 1 requires USAGE_STORE=sqlite, so that all workers share the usage')
+        exit(1)
+
     all_available_plugins = [
         'wolfram', 'weather', 'crypto', 'ddg_web_search', 'ddg_image_search',
         'spotify', 'worldtimeapi', 'youtube_audio_extractor', 'dice',
@@ -116,11 +172,40 @@ def main():
         'plugins': os.environ.get('PLUGINS', ','.join(all_available_plugins)).split(',')
     }
 
+    # Calculate the all-time cost of older usage logs once, before any worker reads them
+    if telegram_config['usage_store'] == 'json':
+        backfill_all_time_costs()
+
     # Setup and run ChatGPT and Telegram bot
+    workers = telegram_config['workers']
+    if workers > 1:
+        worker_openai_config, worker_telegram_config = worker_configs(openai_config, telegram_config, workers)
+        run_sharded(functools.partial(create_bot, worker_openai_config, worker_telegram_config, plugin_config),
+                    telegram_config, workers)
+        return
+
+    telegram_bot, conversation_store = create_bot(openai_config, telegram_config, plugin_config)
+    try:
+        telegram_bot.run()
+    finally:
+        conversation_store.close()
+
+
+def create_bot(openai_config: dict, telegram_config: dict, plugin_config: dict):
+    """
+    Creates the Telegram bot and the conversation store it uses, which must be closed on shutdown.
+    """
+    # Load the tokenizer tables before the first user message arrives
+    try:
+        preload_encodings(openai_config['model'], openai_config['vision_model'])
+    except Exception as e:
+        logging.warning(f'Failed to preload tiktoken encodings: {str(e)}. They will be loaded on first use.')
+
     plugin_manager = PluginManager(config=plugin_config)
-    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager)
-    telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai_helper)
-    telegram_bot.run()
+    conversation_store = create_conversation_store(config=openai_config)
+    openai_helper = OpenAIHelper(config=openai_config, plugin_manager=plugin_manager,
+                                 conversation_store=conversation_store)
+    return ChatGPTTelegramBot(config=telegram_config, openai=openai_helper), conversation_store
 
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
 from __future__ import annotations
+import asyncio
 import datetime
+import functools
+import inspect
 import logging
 import os
 
@@ -12,10 +15,11 @@ import httpx
 import io
 from PIL import Image
 
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-
-from utils import is_direct_result, encode_image, decode_image
+from utils import is_direct_result, encode_image
 from plugin_manager import PluginManager
+from conversation_store import Conversation, ConversationStore
+from retry_policy import call_with_retry
+from admission import AdmissionController, AdmittedStream, PRIORITY_ADMIN, PRIORITY_PRIVATE, PRIORITY_GROUP, PRIORITY_BACKGROUND
 
 # Models can be found here: https://platform.openai.com/docs/models/overview
 # Models gpt-3.5-turbo-0613 and  gpt-3.5-turbo-16k-0613 will be deprecated on June 13, 2024
@@ -56,6 +60,35 @@ def default_max_tokens(model: str) -> int:
         return 4096
 
 
+# tiktoken encodings, resolved once per model name
+encodings: dict[str, tiktoken.Encoding] = {}
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Gets the tiktoken encoding for the given model, caching it for subsequent calls.
+    Models unknown to tiktoken fall back to the o200k_base encoding.
+    :param model: The model name
+    :return: The encoding to use for the model
+    """
+    if model not in encodings:
+        try:
+            encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encodings[model] = tiktoken.get_encoding("o200k_base")
+    return encodings[model]
+
+
+def preload_encodings(*models: str):
+    """
+    Resolves and loads the tiktoken encodings for the given models, so that
+    the BPE tables are not loaded on the first request's critical path.
+    :param models: The model names
+    """
+    for model in models:
+        get_encoding(model)
+
+
 def are_functions_available(model: str) -> bool:
     """
     Whether the given model supports functions
@@ -67,6 +100,33 @@ def are_functions_available(model: str) -> bool:
     return True
 
 
+def pins_conversation(method):
+    """
+    Decorates an OpenAIHelper method taking the chat ID as first argument, so that the conversation
+    of the chat is not evicted from the conversation store while the request is in flight.
+    Works with coroutines and async generators, which keep the pin until they are exhausted or closed.
+    """
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def generator(self, chat_id, *args, **kwargs):
+            self.conversation_store.pin(chat_id)
+            try:
+                async for item in method(self, chat_id, *args, **kwargs):
+                    yield item
+            finally:
+                self.conversation_store.unpin(chat_id)
+        return generator
+
+    @functools.wraps(method)
+    async def coroutine(self, chat_id, *args, **kwargs):
+        self.conversation_store.pin(chat_id)
+        try:
+            return await method(self, chat_id, *args, **kwargs)
+        finally:
+            self.conversation_store.unpin(chat_id)
+    return coroutine
+
+
 # Load translations
 parent_dir_path = os.path.join(os.path.dirname(__file__), os.pardir)
 translations_file_path = os.path.join(parent_dir_path, 'translations.json')
@@ -97,19 +157,21 @@ class OpenAIHelper:
     ChatGPT helper class.
     """
 
-    def __init__(self, config: dict, plugin_manager: PluginManager):
+    def __init__(self, config: dict, plugin_manager: PluginManager, conversation_store: ConversationStore):
         """
         Initializes the OpenAI helper class with the given configuration.
         :param config: A dictionary containing the GPT configuration
         :param plugin_manager: The plugin manager
+        :param conversation_store: The store holding the conversations of all chats
         """
         http_client = httpx.AsyncClient(proxy=config['proxy']) if 'proxy' in config else None
-        self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client)
+        # Requests are retried by with_retry, the client must not retry them on its own as well
+        self.client = openai.AsyncOpenAI(api_key=config['api_key'], http_client=http_client, max_retries=0)
         self.config = config
         self.plugin_manager = plugin_manager
-        self.conversations: dict[int: list] = {}  # {chat_id: history}
-        self.conversations_vision: dict[int: bool] = {}  # {chat_id: is_vision}
-        self.last_updated: dict[int: datetime] = {}  # {chat_id: last_update_timestamp}
+        self.conversation_store = conversation_store
+        self.summary_tasks: dict[int, asyncio.Task] = {}  # {chat_id: background summarisation task}
+        self.admission = AdmissionController(config['max_concurrent_requests'], config['tokens_per_minute'])
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
         """
@@ -117,10 +179,11 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A tuple containing the number of messages and tokens used
         """
-        if chat_id not in self.conversations:
+        if self.conversation_store.get(chat_id) is None:
             self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        return len(self.__conversation(chat_id).messages), self.__count_conversation_tokens(chat_id)
 
+    @pins_conversation
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
         """
         Gets a full response from the GPT model.
@@ -131,7 +194,7 @@ class OpenAIHelper:
         plugins_used = ()
         
         # First try natural language plugin routing if enabled
-        if self.config.get('enable_natural_language_plugin_routing', False) and self.config['enable_functions'] and not self.conversations_vision.get(chat_id, False):
+        if self.config.get('enable_natural_language_plugin_routing', False) and self.config['enable_functions'] and not self.__is_vision_conversation(chat_id):
             try:
                 # Import here to avoid circular imports
                 from plugin_router import PluginRouter
@@ -188,7 +251,7 @@ class OpenAIHelper:
                 # Continue with normal response generation
         
         response = await self.__common_get_chat_response(chat_id, query)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
+        if self.config['enable_functions'] and not self.__is_vision_conversation(chat_id):
             response, plugins_used = await self.__handle_function_call(chat_id, response)
             if is_direct_result(response):
                 return response, '0'
@@ -206,6 +269,7 @@ class OpenAIHelper:
         else:
             answer = response.choices[0].message.content.strip()
             self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__schedule_background_summary(chat_id)
 
         bot_language = self.config['bot_language']
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
@@ -222,32 +286,38 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
+    @pins_conversation
     async def get_chat_response_stream(self, chat_id: int, query: str):
         """
         Stream response from the GPT model.
         :param chat_id: The chat ID
         :param query: The query to send to the model
-        :return: The answer from the model and the number of tokens used, or 'not_finished'
+        :return: Each new part of the answer with 'not_finished', then the whole answer and the number of tokens used
         """
         plugins_used = ()
         response = await self.__common_get_chat_response(chat_id, query, stream=True)
-        if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
+        if self.config['enable_functions'] and not self.__is_vision_conversation(chat_id):
             response, plugins_used = await self.__handle_function_call(chat_id, response, stream=True)
             if is_direct_result(response):
                 yield response, '0'
                 return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
+        parts = []
+        try:
+            async for chunk in response:
+                if len(chunk.choices) == 0:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    parts.append(delta.content)
+                    yield delta.content, 'not_finished'
+        finally:
+            # Release the request if the answer is not read to the end
+            await response.close()
+        answer = ''.join(parts).strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        self.__schedule_background_summary(chat_id)
+        tokens_used = str(self.__count_conversation_tokens(chat_id))
 
         show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -260,12 +330,6 @@ class OpenAIHelper:
 
         yield answer, tokens_used
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
     async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
         """
         Request a response from the GPT model.
@@ -275,34 +339,24 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            if self.conversation_store.get(chat_id) is None or self.__max_age_reached(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
+            self.__conversation(chat_id).last_updated = datetime.datetime.now()
 
             self.__add_to_history(chat_id, role="user", content=query)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
-
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+            # Compact the chat history if it's too long to avoid excessive token usage
+            if self.__is_history_too_long(chat_id):
+                await self.__wait_for_background_summary(chat_id)
+
+            if self.__is_history_too_long(chat_id):
+                await self.__compact_history(chat_id)
 
             max_tokens_str = 'max_completion_tokens' if self.config['model'] in O_MODELS else 'max_tokens'
             common_args = {
-                'model': self.config['model'] if not self.conversations_vision[chat_id] else self.config['vision_model'],
-                'messages': self.conversations[chat_id],
+                'model': self.config['model'] if not self.__is_vision_conversation(chat_id) else self.config['vision_model'],
+                'messages': self.__conversation(chat_id).messages,
                 'temperature': self.config['temperature'],
                 'n': self.config['n_choices'],
                 max_tokens_str: self.config['max_tokens'],
@@ -311,12 +365,13 @@ class OpenAIHelper:
                 'stream': stream
             }
 
-            if self.config['enable_functions'] and not self.conversations_vision[chat_id]:
+            if self.config['enable_functions'] and not self.__is_vision_conversation(chat_id):
                 functions = self.plugin_manager.get_functions_specs()
                 if len(functions) > 0:
-                    common_args['functions'] = self.plugin_manager.get_functions_specs()
+                    common_args['functions'] = functions
                     common_args['function_call'] = 'auto'
-            return await self.client.chat.completions.create(**common_args)
+            return await self.__create_chat_completion(self.request_priority(chat_id),
+                                                       self.__count_conversation_tokens(chat_id), **common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -340,6 +395,8 @@ class OpenAIHelper:
                         if first_choice.delta.function_call.arguments:
                             arguments += first_choice.delta.function_call.arguments
                     elif first_choice.finish_reason and first_choice.finish_reason == 'function_call':
+                        # The function result is sent in a new request, this one is finished
+                        await response.close()
                         break
                     else:
                         return response, plugins_used
@@ -371,9 +428,11 @@ class OpenAIHelper:
             return function_response, plugins_used
 
         self.__add_function_call_to_history(chat_id=chat_id, function_name=function_name, content=function_response)
-        response = await self.client.chat.completions.create(
+        response = await self.__create_chat_completion(
+            self.request_priority(chat_id),
+            self.__count_conversation_tokens(chat_id),
             model=self.config['model'],
-            messages=self.conversations[chat_id],
+            messages=self.__conversation(chat_id).messages,
             functions=self.plugin_manager.get_functions_specs(),
             function_call='auto' if times < self.config['functions_max_consecutive_calls'] else 'none',
             stream=stream
@@ -388,14 +447,14 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.images.generate(
+            response = await self.with_retry(lambda: self.client.images.generate(
                 prompt=prompt,
                 n=1,
                 model=self.config['image_model'],
                 quality=self.config['image_quality'],
                 style=self.config['image_style'],
                 size=self.config['image_size']
-            )
+            ))
 
             if len(response.data) == 0:
                 logging.error(f'No response from GPT: {str(response)}')
@@ -416,12 +475,12 @@ class OpenAIHelper:
         """
         bot_language = self.config['bot_language']
         try:
-            response = await self.client.audio.speech.create(
+            response = await self.with_retry(lambda: self.client.audio.speech.create(
                 model=self.config['tts_model'],
                 voice=self.config['tts_voice'],
                 input=text,
                 response_format='opus'
-            )
+            ))
 
             temp_file = io.BytesIO()
             temp_file.write(response.read())
@@ -437,35 +496,37 @@ class OpenAIHelper:
         try:
             with open(filename, "rb") as audio:
                 prompt_text = self.config['whisper_prompt']
-                result = await self.client.audio.transcriptions.create(model="whisper-1", file=audio, prompt=prompt_text)
+
+                async def _transcribe():
+                    audio.seek(0)
+                    return await self.client.audio.transcriptions.create(model="whisper-1", file=audio,
+                                                                         prompt=prompt_text)
+
+                result = await self.with_retry(_transcribe)
                 return result.text
         except Exception as e:
             logging.exception(e)
             raise Exception(f"⚠️ _{localized_text('error', self.config['bot_language'])}._ ⚠️\n{str(e)}") from e
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(openai.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
-    async def __common_get_chat_response_vision(self, chat_id: int, content: list, stream=False):
+    async def __common_get_chat_response_vision(self, chat_id: int, content: list, image_tokens: int = 0,
+                                                stream=False):
         """
         Request a response from the GPT model.
         :param chat_id: The chat ID
-        :param query: The query to send to the model
+        :param content: The content parts to send to the model
+        :param image_tokens: The precomputed token cost of the image in the content
         :return: The answer from the model and the number of tokens used
         """
         bot_language = self.config['bot_language']
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
+            if self.conversation_store.get(chat_id) is None or self.__max_age_reached(chat_id):
                 self.reset_chat_history(chat_id)
 
-            self.last_updated[chat_id] = datetime.datetime.now()
+            self.__conversation(chat_id).last_updated = datetime.datetime.now()
 
             if self.config['enable_vision_follow_up_questions']:
-                self.conversations_vision[chat_id] = True
-                self.__add_to_history(chat_id, role="user", content=content)
+                self.__conversation(chat_id).is_vision = True
+                self.__add_to_history(chat_id, role="user", content=content, image_tokens=image_tokens)
             else:
                 for message in content:
                     if message['type'] == 'text':
@@ -473,30 +534,18 @@ class OpenAIHelper:
                         break
                 self.__add_to_history(chat_id, role="user", content=query)
 
-            # Summarize the chat history if it's too long to avoid excessive token usage
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            exceeded_max_tokens = token_count + self.config['max_tokens'] > self.__max_model_tokens()
-            exceeded_max_history_size = len(self.conversations[chat_id]) > self.config['max_history_size']
+            # Compact the chat history if it's too long to avoid excessive token usage
+            if self.__is_history_too_long(chat_id):
+                await self.__wait_for_background_summary(chat_id)
 
-            if exceeded_max_tokens or exceeded_max_history_size:
-                logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
-                try:
-                    
-                    last = self.conversations[chat_id][-1]
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    logging.debug(f'Summary: {summary}')
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.conversations[chat_id] += [last]
-                except Exception as e:
-                    logging.warning(f'Error while summarising chat history: {str(e)}. Popping elements instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
+            if self.__is_history_too_long(chat_id):
+                await self.__compact_history(chat_id)
 
             message = {'role':'user', 'content':content}
 
             common_args = {
                 'model': self.config['vision_model'],
-                'messages': self.conversations[chat_id][:-1] + [message],
+                'messages': self.__conversation(chat_id).messages[:-1] + [message],
                 'temperature': self.config['temperature'],
                 'n': 1, # several choices is not implemented yet
                 'max_tokens': self.config['vision_max_tokens'],
@@ -514,7 +563,8 @@ class OpenAIHelper:
             #         common_args['functions'] = self.plugin_manager.get_functions_specs()
             #         common_args['function_call'] = 'auto'
             
-            return await self.client.chat.completions.create(**common_args)
+            return await self.__create_chat_completion(self.request_priority(chat_id),
+                                                       self.__count_conversation_tokens(chat_id), **common_args)
 
         except openai.RateLimitError as e:
             raise e
@@ -526,17 +576,14 @@ class OpenAIHelper:
             raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
 
 
+    @pins_conversation
     async def interpret_image(self, chat_id, fileobj, prompt=None):
         """
         Interprets a given PNG image file using the Vision model.
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
-
-        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
-                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
+        content, image_tokens = self.__build_vision_content(fileobj, prompt)
 
-        response = await self.__common_get_chat_response_vision(chat_id, content)
+        response = await self.__common_get_chat_response_vision(chat_id, content, image_tokens)
 
         
 
@@ -560,6 +607,7 @@ class OpenAIHelper:
         else:
             answer = response.choices[0].message.content.strip()
             self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__schedule_background_summary(chat_id)
 
         bot_language = self.config['bot_language']
         # Plugins are not enabled either
@@ -577,17 +625,15 @@ class OpenAIHelper:
 
         return answer, response.usage.total_tokens
 
+    @pins_conversation
     async def interpret_image_stream(self, chat_id, fileobj, prompt=None):
         """
         Interprets a given PNG image file using the Vision model.
+        :return: Each new part of the answer with 'not_finished', then the whole answer and the number of tokens used
         """
-        image = encode_image(fileobj)
-        prompt = self.config['vision_prompt'] if prompt is None else prompt
-
-        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
-                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
+        content, image_tokens = self.__build_vision_content(fileobj, prompt)
 
-        response = await self.__common_get_chat_response_vision(chat_id, content, stream=True)
+        response = await self.__common_get_chat_response_vision(chat_id, content, image_tokens, stream=True)
 
         
 
@@ -597,17 +643,22 @@ class OpenAIHelper:
         #         yield response, '0'
         #         return
 
-        answer = ''
-        async for chunk in response:
-            if len(chunk.choices) == 0:
-                continue
-            delta = chunk.choices[0].delta
-            if delta.content:
-                answer += delta.content
-                yield answer, 'not_finished'
-        answer = answer.strip()
+        parts = []
+        try:
+            async for chunk in response:
+                if len(chunk.choices) == 0:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    parts.append(delta.content)
+                    yield delta.content, 'not_finished'
+        finally:
+            # Release the request if the answer is not read to the end
+            await response.close()
+        answer = ''.join(parts).strip()
         self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+        self.__schedule_background_summary(chat_id)
+        tokens_used = str(self.__count_conversation_tokens(chat_id))
 
         #show_plugins_used = len(plugins_used) > 0 and self.config['show_plugins_used']
         #plugin_names = tuple(self.plugin_manager.get_plugin_source_name(plugin) for plugin in plugins_used)
@@ -620,14 +671,63 @@ class OpenAIHelper:
 
         yield answer, tokens_used
 
+    def __build_vision_content(self, fileobj, prompt=None) -> tuple[list, int]:
+        """
+        Builds the content parts for a vision request from the given PNG image file.
+        The token cost of the image is computed here, from the image header, so that
+        the image never has to be decoded again when counting conversation tokens.
+        :param fileobj: The image file
+        :param prompt: The prompt to send along with the image
+        :return: The content parts and the token cost of the image
+        """
+        image = encode_image(fileobj)
+        prompt = self.config['vision_prompt'] if prompt is None else prompt
+
+        content = [{'type':'text', 'text':prompt}, {'type':'image_url', \
+                    'image_url': {'url':image, 'detail':self.config['vision_detail'] } }]
+
+        image_tokens = 0
+        if self.config['enable_vision_follow_up_questions']:
+            fileobj.seek(0)
+            width, height = Image.open(fileobj).size
+            image_tokens = self.__count_tokens_vision(width, height)
+        return content, image_tokens
+
     def reset_chat_history(self, chat_id, content=''):
         """
         Resets the conversation history.
         """
         if content == '':
             content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "assistant" if self.config['model'] in O_MODELS else "system", "content": content}]
-        self.conversations_vision[chat_id] = False
+        self.conversation_store.put(chat_id, Conversation(last_updated=datetime.datetime.now()))
+        self.__append_to_history(chat_id, {"role": "assistant" if self.config['model'] in O_MODELS else "system",
+                                           "content": content})
+
+    def remove_expired_conversations(self) -> tuple[int, int]:
+        """
+        Removes the conversations that reached the maximum conversation age.
+        :return: The number of conversations removed and the estimated number of bytes reclaimed
+        """
+        max_age_minutes = self.config['max_conversation_age_minutes']
+        before = datetime.datetime.now() - datetime.timedelta(minutes=max_age_minutes)
+        return self.conversation_store.delete_expired(before)
+
+    def __conversation(self, chat_id) -> Conversation:
+        """
+        Gets the conversation of the given chat, which must exist.
+        :param chat_id: The chat ID
+        :return: The conversation
+        """
+        return self.conversation_store.get(chat_id)
+
+    def __is_vision_conversation(self, chat_id) -> bool:
+        """
+        Checks if the conversation of the given chat uses the vision model.
+        :param chat_id: The chat ID
+        :return: A boolean indicating whether the conversation uses the vision model
+        """
+        conversation = self.conversation_store.get(chat_id)
+        return conversation is not None and conversation.is_vision
 
     def __max_age_reached(self, chat_id) -> bool:
         """
@@ -635,9 +735,9 @@ class OpenAIHelper:
         :param chat_id: The chat ID
         :return: A boolean indicating whether the maximum conversation age has been reached
         """
-        if chat_id not in self.last_updated:
+        last_updated = self.__conversation(chat_id).last_updated
+        if last_updated is None:
             return False
-        last_updated = self.last_updated[chat_id]
         now = datetime.datetime.now()
         max_age_minutes = self.config['max_conversation_age_minutes']
         return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
@@ -646,34 +746,256 @@ class OpenAIHelper:
         """
         Adds a function call to the conversation history
         """
-        self.conversations[chat_id].append({"role": "function", "name": function_name, "content": content})
+        self.__append_to_history(chat_id, {"role": "function", "name": function_name, "content": content})
 
-    def __add_to_history(self, chat_id, role, content):
+    def __add_to_history(self, chat_id, role, content, image_tokens=0):
         """
         Adds a message to the conversation history.
         :param chat_id: The chat ID
         :param role: The role of the message sender
         :param content: The message content
+        :param image_tokens: The precomputed token cost of the images in the content, if any
+        """
+        message = {"role": role, "content": content}
+        self.__append_to_history(chat_id, message, self.__count_message_tokens(message) + image_tokens)
+
+    def __append_to_history(self, chat_id, message: dict, tokens: int = None):
+        """
+        Appends a message to the conversation history, counting its tokens once
+        and adding them to the running total for the conversation.
+        :param chat_id: The chat ID
+        :param message: The message to append
+        :param tokens: The number of tokens of the message, if already known
         """
-        self.conversations[chat_id].append({"role": role, "content": content})
+        if tokens is None:
+            tokens = self.__count_message_tokens(message)
+        conversation = self.__conversation(chat_id)
+        conversation.append(message, tokens)
+        self.conversation_store.put(chat_id, conversation)
 
-    async def __summarise(self, conversation) -> str:
+    def __trim_history(self, chat_id):
+        """
+        Drops the oldest messages of the conversation history until it fits the token budget
+        and the maximum history size. The system message and the latest message are always kept.
+        :param chat_id: The chat ID
+        """
+        conversation = self.__conversation(chat_id)
+        history = conversation.messages
+        message_tokens = conversation.message_tokens
+        token_budget = self.__max_model_tokens() - self.config['max_tokens'] - 3
+        token_count = conversation.tokens
+        first_kept = 1
+        while first_kept < len(history) - 1 and \
+                (token_count > token_budget or len(history) - first_kept + 1 > self.config['max_history_size']):
+            token_count -= message_tokens[first_kept]
+            first_kept += 1
+
+        conversation.replace(history[:1] + history[first_kept:], message_tokens[:1] + message_tokens[first_kept:])
+        self.conversation_store.put(chat_id, conversation)
+
+    def __count_conversation_tokens(self, chat_id) -> int:
+        """
+        Gets the number of tokens required to send the conversation history,
+        using the cached per-message counts.
+        :param chat_id: The chat ID
+        :return: the number of tokens required
+        """
+        return self.__conversation(chat_id).tokens + 3  # every reply is primed with <|start|>assistant<|message|>
+
+    def __is_history_too_long(self, chat_id, margin: float = 0.0) -> bool:
+        """
+        Checks if the conversation history exceeds the token or message limits.
+        :param chat_id: The chat ID
+        :param margin: Fraction of the limits to keep free, e.g. 0.2 to check against 80% of the limits
+        :return: A boolean indicating whether the history is too long
+        """
+        exceeded_max_history_size = len(self.__conversation(chat_id).messages) > self.config['max_history_size'] * (1 - margin)
+        return self.__exceeds_max_tokens(chat_id, margin) or exceeded_max_history_size
+
+    def __exceeds_max_tokens(self, chat_id, margin: float = 0.0) -> bool:
+        """
+        Checks if the conversation history leaves no room for the completion in the model's context.
+        :param chat_id: The chat ID
+        :param margin: Fraction of the limit to keep free
+        :return: A boolean indicating whether the token limit is exceeded
+        """
+        token_count = self.__count_conversation_tokens(chat_id)
+        return token_count + self.config['max_tokens'] > self.__max_model_tokens() * (1 - margin)
+
+    async def __compact_history(self, chat_id):
+        """
+        Compacts the conversation history according to the configured history strategy:
+        'summarise' replaces it with a summary, 'window' drops the oldest messages and
+        'hybrid' only summarises when the token limit is exceeded. The latest message is kept.
+        :param chat_id: The chat ID
+        """
+        strategy = self.config['history_strategy']
+        if strategy == 'window' or (strategy == 'hybrid' and not self.__exceeds_max_tokens(chat_id)):
+            logging.info(f'Chat history for chat ID {chat_id} is too long. Dropping oldest messages...')
+            self.__trim_history(chat_id)
+            return
+
+        logging.info(f'Chat history for chat ID {chat_id} is too long. Summarising...')
+        try:
+            conversation = self.__conversation(chat_id)
+            last = conversation.messages[-1]
+            last_tokens = conversation.message_tokens[-1]
+            summary = await self.__summarise(conversation.messages[:-1], sum(conversation.message_tokens[:-1]),
+                                             self.request_priority(chat_id))
+            logging.debug(f'Summary: {summary}')
+            self.reset_chat_history(chat_id, conversation.messages[0]['content'])
+            self.__add_to_history(chat_id, role="assistant", content=summary)
+            self.__append_to_history(chat_id, last, last_tokens)
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history: {str(e)}. Dropping oldest messages instead...')
+            self.__trim_history(chat_id)
+
+    def __schedule_background_summary(self, chat_id):
+        """
+        Schedules the summarisation of the conversation history as a background task
+        if the history is within the configured margin of its limits, so that the next
+        request does not have to wait for it.
+        :param chat_id: The chat ID
+        """
+        strategy = self.config['history_strategy']
+        if not self.config['enable_background_summarisation'] or strategy == 'window' \
+                or chat_id in self.summary_tasks:
+            return
+        margin = self.config['background_summarisation_margin']
+        # The hybrid strategy only summarises for the token limit, exceeding the history size drops messages
+        if strategy == 'hybrid' and not self.__exceeds_max_tokens(chat_id, margin):
+            return
+        if not self.__is_history_too_long(chat_id, margin=margin):
+            return
+
+        logging.info(f'Chat history for chat ID {chat_id} is close to its limit. Summarising in the background...')
+        conversation = self.__conversation(chat_id)
+        # Pinned until the task is done, so that the conversation is not evicted while it is summarised
+        self.conversation_store.pin(chat_id)
+        task = asyncio.get_running_loop().create_task(
+            self.__summarise_in_background(chat_id, conversation, len(conversation.messages)))
+        self.summary_tasks[chat_id] = task
+        task.add_done_callback(lambda _: self.__background_summary_done(chat_id))
+
+    def __background_summary_done(self, chat_id):
+        """
+        Forgets the background summarisation task of a chat once it is done and unpins the conversation.
+        :param chat_id: The chat ID
+        """
+        self.summary_tasks.pop(chat_id, None)
+        self.conversation_store.unpin(chat_id)
+
+    async def cancel_background_summaries(self):
+        """
+        Cancels the background summarisation tasks and waits for them to finish, so that none
+        is left running when the conversation store is closed.
+        """
+        tasks = list(self.summary_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __wait_for_background_summary(self, chat_id):
+        """
+        Waits for the background summarisation of the conversation history, if one is running.
+        :param chat_id: The chat ID
+        """
+        task = self.summary_tasks.get(chat_id)
+        if task is not None:
+            await asyncio.shield(task)
+
+    async def __summarise_in_background(self, chat_id, conversation: Conversation, summarised_count: int):
+        """
+        Summarises the first messages of the conversation history and replaces them with the summary.
+        Messages added while the summary was being generated are kept, and the summary is
+        discarded if the conversation has been reset in the meantime.
+        :param chat_id: The chat ID
+        :param conversation: The conversation at the time the summarisation was scheduled
+        :param summarised_count: The number of messages to summarise
+        """
+        history = conversation.messages
+        try:
+            summary = await self.__summarise(history[:summarised_count],
+                                             sum(conversation.message_tokens[:summarised_count]), PRIORITY_BACKGROUND)
+            logging.debug(f'Summary: {summary}')
+        except Exception as e:
+            logging.warning(f'Error while summarising chat history in the background: {str(e)}')
+            return
+
+        if self.conversation_store.get(chat_id) is not conversation or conversation.messages is not history:
+            logging.info(f'Chat history for chat ID {chat_id} changed while summarising. Discarding summary...')
+            return
+
+        message_tokens = conversation.message_tokens
+        conversation.replace([], [])
+        self.__append_to_history(chat_id, history[0], message_tokens[0])
+        self.__add_to_history(chat_id, role="assistant", content=summary)
+        for message, tokens in zip(history[summarised_count:], message_tokens[summarised_count:]):
+            self.__append_to_history(chat_id, message, tokens)
+
+    async def __summarise(self, conversation, tokens: int, priority: int) -> str:
         """
         Summarises the conversation history.
         :param conversation: The conversation history
+        :param tokens: The number of tokens of the conversation history
+        :param priority: The priority of the summarisation request
         :return: The summary
         """
         messages = [
             {"role": "assistant", "content": "Summarize this conversation in 700 characters or less"},
             {"role": "user", "content": str(conversation)}
         ]
-        response = await self.client.chat.completions.create(
+        response = await self.__create_chat_completion(
+            priority,
+            tokens,
             model=self.config['model'],
             messages=messages,
             temperature=1 if self.config['model'] in O_MODELS else 0.4
         )
         return response.choices[0].message.content
 
+    async def __create_chat_completion(self, priority: int, prompt_tokens: int, **kwargs):
+        """
+        Requests a chat completion once the admission controller admits it.
+        A streamed request stays admitted until its stream is exhausted or closed.
+        :param priority: The priority of the request
+        :param prompt_tokens: The estimated number of prompt tokens, the maximum completion tokens are added to it
+        :param kwargs: The arguments of the chat completion request
+        :return: The chat completion response, or an AdmittedStream of it for streamed requests
+        """
+        max_tokens = kwargs.get('max_tokens', kwargs.get('max_completion_tokens', self.config['max_tokens']))
+        tokens = prompt_tokens + max_tokens * kwargs.get('n', 1)
+        await self.admission.acquire(tokens, priority)
+        try:
+            response = await self.with_retry(lambda: self.client.chat.completions.create(**kwargs))
+        except BaseException:
+            self.admission.release()
+            raise
+        if kwargs.get('stream'):
+            return AdmittedStream(response, self.admission.release)
+        self.admission.release()
+        return response
+
+    async def with_retry(self, call):
+        """
+        Awaits an OpenAI request, retrying it on rate limits and transient errors as long as the
+        server asks for, or with jittered exponential backoff.
+        :param call: A function returning a new awaitable of the request on each call
+        :return: The result of the request
+        """
+        return await call_with_retry(call, self.config['openai_max_retries'] + 1, self.config['openai_max_retry_wait'])
+
+    def request_priority(self, chat_id) -> int:
+        """
+        Gets the admission priority of the requests of the given chat.
+        :param chat_id: The chat ID
+        :return: The priority, admins first, then private chats, then groups
+        """
+        if str(chat_id) in self.config['admin_user_id_set']:
+            return PRIORITY_ADMIN
+        # Private chats have the ID of the user, group chat IDs are negative
+        return PRIORITY_PRIVATE if int(chat_id) > 0 else PRIORITY_GROUP
+
     def __max_model_tokens(self):
         base = 4096
         if self.config['model'] in GPT_3_MODELS:
@@ -703,59 +1025,45 @@ class OpenAIHelper:
         )
 
     # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def __count_tokens(self, messages) -> int:
+    def __count_message_tokens(self, message: dict) -> int:
         """
-        Counts the number of tokens required to send the given messages.
-        :param messages: the messages to send
+        Counts the number of tokens a single message contributes to a request.
+        Models outside GPT_ALL_MODELS are counted like them, with the default encoding if tiktoken
+        does not know the model, so that an unknown model does not break the conversation history.
+        :param message: the message to count
         :return: the number of tokens required
         """
-        model = self.config['model']
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            encoding = tiktoken.get_encoding("o200k_base")
-
-        if model in GPT_ALL_MODELS:
-            tokens_per_message = 3
-            tokens_per_name = 1
-        else:
-            raise NotImplementedError(f"""num_tokens_from_messages() is not implemented for model {model}.""")
-        num_tokens = 0
-        for message in messages:
-            num_tokens += tokens_per_message
-            for key, value in message.items():
-                if key == 'content':
-                    if isinstance(value, str):
-                        num_tokens += len(encoding.encode(value))
-                    else:
-                        for message1 in value:
-                            if message1['type'] == 'image_url':
-                                image = decode_image(message1['image_url']['url'])
-                                num_tokens += self.__count_tokens_vision(image)
-                            else:
-                                num_tokens += len(encoding.encode(message1['text']))
-                else:
+        encoding = get_encoding(self.config['model'])
+        tokens_per_message = 3
+        tokens_per_name = 1
+        num_tokens = tokens_per_message
+        for key, value in message.items():
+            if key == 'content':
+                if isinstance(value, str):
                     num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                else:
+                    for message1 in value:
+                        # image parts are accounted for when the content is built, see __build_vision_content
+                        if message1['type'] == 'text':
+                            num_tokens += len(encoding.encode(message1['text']))
+            else:
+                num_tokens += len(encoding.encode(value))
+                if key == "name":
+                    num_tokens += tokens_per_name
         return num_tokens
 
-    # no longer needed
-
-    def __count_tokens_vision(self, image_bytes: bytes) -> int:
+    def __count_tokens_vision(self, width: int, height: int) -> int:
         """
         Counts the number of tokens for interpreting an image.
-        :param image_bytes: image to interpret
+        :param width: width of the image to interpret
+        :param height: height of the image to interpret
         :return: the number of tokens required
         """
-        image_file = io.BytesIO(image_bytes)
-        image = Image.open(image_file)
         model = self.config['vision_model']
         if model not in GPT_4_VISION_MODELS:
             raise NotImplementedError(f"""count_tokens_vision() is not implemented for model {model}.""")
         
-        w, h = image.size
+        w, h = width, height
         if w > h: w, h = h, w
         # this computation follows https://platform.openai.com/docs/guides/vision and https://openai.com/pricing#gpt-4-turbo
         base_tokens = 85
@@ -19,6 +19,7 @@ from plugins.webshot import WebshotPlugin
 from plugins.iplocation import IpLocationPlugin
 from plugins.pattern_plugin import PatternPlugin
 from plugins.url_summarize import URLSummarizePlugin
+from plugins.http_client import create_http_client
 
 
 class PluginManager:
@@ -58,12 +59,15 @@ class PluginManager:
         }
         
         self.plugins = []
+        # HTTP client shared by the plugins, so that connections to their APIs are reused
+        self.http_client = create_http_client()
         
         # Try to initialize each plugin and log any errors
         for plugin_name in enabled_plugins:
             if plugin_name in plugin_mapping:
                 try:
                     plugin_instance = plugin_mapping[plugin_name]()
+                    plugin_instance.http_client = self.http_client
                     self.plugins.append(plugin_instance)
                     logging.info(f"Successfully loaded plugin: {plugin_name}")
                 except Exception as e:
@@ -73,11 +77,46 @@ class PluginManager:
                 
         logging.info(f"Enabled plugins: {', '.join([p.__class__.__name__ for p in self.plugins])}")
 
+        self.specs = ()
+        self.plugins_by_function_name = {}
+        self.reload()
+
+    def reload(self):
+        """
+        Rebuild the function specs and the plugin of each function from the plugins.
+        Must be called for changes to the specs of a plugin to be seen, e.g. new patterns.
+        The specs are only replaced if they changed, so that their users can tell by identity
+        """
+        specs = []
+        plugins_by_function_name = {}
+        for plugin in self.plugins:
+            for spec in plugin.get_spec():
+                specs.append(spec)
+                # the first plugin defining a function handles it
+                plugins_by_function_name.setdefault(spec.get('name'), plugin)
+        specs = tuple(specs)
+        if specs != self.specs:
+            self.specs = specs
+        self.plugins_by_function_name = plugins_by_function_name
+
+    def specs_changed(self) -> bool:
+        """
+        Return whether the specs of a plugin changed since the last reload.
+        May read files, so should be called outside the event loop
+        """
+        return any(plugin.specs_changed() for plugin in self.plugins)
+
     def get_functions_specs(self):
         """
-        Return the list of function specs that can be called by the model
+        Return the function specs that can be called by the model, as of the last reload
+        """
+        return self.specs
+
+    async def close(self):
+        """
+        Close the connections of the plugins
         """
-        return [spec for specs in map(lambda plugin: plugin.get_spec(), self.plugins) for spec in specs]
+        await self.http_client.aclose()
 
     async def call_function(self, function_name, helper, arguments):
         """
@@ -102,5 +141,4 @@ class PluginManager:
         Return the plugin instance by function name
         This method is made public to be used by the PluginRouter
         """
-        return next((plugin for plugin in self.plugins
-                    if function_name in map(lambda spec: spec.get('name'), plugin.get_spec())), None)
\ No newline at end of file
+        return self.plugins_by_function_name.get(function_name)
@@ -3,7 +3,7 @@ import logging
 import re
 from typing import Dict, List, Tuple, Optional
 
-from openai_helper import OpenAIHelper
+from openai_helper import OpenAIHelper, get_encoding
 from plugin_manager import PluginManager
 
 # Import the detailed plugin descriptions
@@ -22,9 +22,19 @@ class PluginRouter:
     def __init__(self, openai_helper: OpenAIHelper, plugin_manager: PluginManager):
         self.openai = openai_helper
         self.plugin_manager = plugin_manager
+        self.specs = self.plugin_manager.get_functions_specs()
         self.plugin_info = self._generate_plugin_descriptions()
         self.last_function_name = None
 
+    def _refresh_plugin_info(self):
+        """
+        Regenerates the plugin descriptions if the plugins were reloaded since they were generated
+        """
+        specs = self.plugin_manager.get_functions_specs()
+        if specs is not self.specs:
+            self.specs = specs
+            self.plugin_info = self._generate_plugin_descriptions()
+
     def _generate_plugin_descriptions(self) -> Dict[str, Dict]:
         """
         Generates detailed descriptions of all available plugins and their functions
@@ -75,6 +85,7 @@ class PluginRouter:
         - function_name: The name of the function to call (or None if no suitable function found)
         - parameters: Parameters to pass to the function
         """
+        self._refresh_plugin_info()
 
         url_summarize_patterns = [
             r"summarize .*https?://",
@@ -134,12 +145,14 @@ class PluginRouter:
                 {"role": "user", "content": query}
             ]
             
-            response = await self.openai.client.chat.completions.create(
-                model=self.openai.config['model'],
-                messages=messages,
-                temperature=0.1,  # Lower temperature for more deterministic results
-                max_tokens=800
-            )
+            tokens = len(get_encoding(self.openai.config['model']).encode(system_prompt + query)) + 800
+            async with self.openai.admission.admit(tokens, self.openai.request_priority(chat_id)):
+                response = await self.openai.with_retry(lambda: self.openai.client.chat.completions.create(
+                    model=self.openai.config['model'],
+                    messages=messages,
+                    temperature=0.1,  # Lower temperature for more deterministic results
+                    max_tokens=800
+                ))
             
             content = response.choices[0].message.content
             
@@ -1,6 +1,5 @@
 from typing import Dict
 
-import requests
 
 from .plugin import Plugin
 
@@ -27,4 +26,4 @@ class CryptoPlugin(Plugin):
         }]
 
     async def execute(self, function_name, helper, **kwargs) -> Dict:
-        return requests.get(f"https://api.coincap.io/v2/rates/{kwargs['asset']}").json()
+        return (await self.http_client.get(f"https://api.coincap.io/v2/rates/{kwargs['asset']}")).json()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+
+import httpx
+
+# Timeouts of the requests to external APIs, in seconds
+HTTP_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+# Connections kept open for reuse, and the maximum number of concurrent requests over all hosts and per host
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_CONNECTIONS_PER_HOST = 10
+
+
+class HostLimitedStream(httpx.AsyncByteStream):
+    """
+    The body of a response counted against its host's limit, which calls release once when it is closed.
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, release):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+class HostLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    A transport letting at most a maximum number of requests to the same host run at once,
+    so that a slow upstream cannot take all the connections of the pool.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_per_host: int):
+        self.transport = transport
+        self.max_per_host = max_per_host
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+        self.requests: dict[str, int] = {}  # {host: number of requests running or waiting}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.max_per_host)
+        semaphore = self.semaphores[host]
+        self.requests[host] = self.requests.get(host, 0) + 1
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            self.__release(host, None)
+            raise
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.__release(host, semaphore)
+            raise
+        if response.is_closed:
+            # The body was already read by the transport
+            self.__release(host, semaphore)
+            return response
+        # The request runs until its body is read or the response is closed
+        response.stream = HostLimitedStream(response.stream, lambda: self.__release(host, semaphore))
+        return response
+
+    def __release(self, host: str, semaphore: asyncio.Semaphore | None):
+        if semaphore is not None:
+            semaphore.release()
+        self.requests[host] -= 1
+        if self.requests[host] == 0:
+            # Only keep the semaphores of the hosts in use
+            del self.requests[host]
+            del self.semaphores[host]
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Creates the HTTP client shared by the plugins. Connections are pooled and kept alive
+    between requests, and HTTP/2 is used when the h2 package is installed.
+    """
+    transport = httpx.AsyncHTTPTransport(
+        http2=importlib.util.find_spec('h2') is not None,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+    )
+    return httpx.AsyncClient(
+        transport=HostLimitedTransport(transport, HTTP_MAX_CONNECTIONS_PER_HOST),
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+    )
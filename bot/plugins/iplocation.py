@@ -1,4 +1,3 @@
-import requests
 from typing import Dict
 
 from .plugin import Plugin
@@ -30,7 +29,7 @@ class IpLocationPlugin(Plugin):
         BASE_URL = "https://api.ip.fm/?ip={}"
         url = BASE_URL.format(ip)
         try:
-            response = requests.get(url)
+            response = await self.http_client.get(url)
             response_data = response.json()
             country = response_data.get('data', {}).get('country', "None")
             subdivisions = response_data.get('data', {}).get('subdivisions', "None")
@@ -3,10 +3,14 @@
 import os
 import logging
 import json
+from collections import OrderedDict
 from typing import Dict, List
 
 from .plugin import Plugin
 
+# Maximum number of pattern system prompts kept in memory
+PATTERN_CONTENT_CACHE_SIZE = 32
+
 
 class PatternPlugin(Plugin):
     """
@@ -18,6 +22,13 @@ class PatternPlugin(Plugin):
         os.makedirs(self.patterns_dir, exist_ok=True)
         # Load pattern explanations file
         self.pattern_explanations = self._load_pattern_explanations()
+        # Available patterns, as of the modification times of the pattern directories: [(name, mtime)]
+        self.patterns = []
+        self.patterns_mtimes = None
+        # The patterns in the specs last returned by get_spec
+        self.spec_patterns = None
+        # Recently used system prompts: {pattern_name: (modification time, content)}
+        self.pattern_contents = OrderedDict()
         
     def _load_pattern_explanations(self) -> Dict:
         """
@@ -66,11 +77,19 @@ class PatternPlugin(Plugin):
             return {}
     
     def get_available_patterns(self) -> List[str]:
-        """Get a list of available pattern names"""
+        """
+        Get a list of available pattern names. The pattern directories are only scanned again for their
+        system.md when the modification time of one of them changes, i.e. when a pattern directory is added,
+        removed or renamed, or a system.md is added to or removed from one
+        """
         try:
-            return [d for d in os.listdir(self.patterns_dir) 
-                   if os.path.isdir(os.path.join(self.patterns_dir, d)) 
-                   and os.path.exists(os.path.join(self.patterns_dir, d, 'system.md'))]
+            with os.scandir(self.patterns_dir) as entries:
+                mtimes = sorted((entry.name, entry.stat().st_mtime_ns) for entry in entries if entry.is_dir())
+            if mtimes != self.patterns_mtimes:
+                self.patterns = [d for d, _ in mtimes
+                                 if os.path.exists(os.path.join(self.patterns_dir, d, 'system.md'))]
+                self.patterns_mtimes = mtimes
+            return list(self.patterns)
         except Exception as e:
             logging.error(f"Failed to list patterns: {str(e)}")
             return []
@@ -82,13 +101,27 @@ class PatternPlugin(Plugin):
         return "No description available"
     
     def get_pattern_content(self, pattern_name: str) -> str:
-        """Read the content of a pattern's system.md file"""
+        """
+        Read the content of a pattern's system.md file. The most recently used ones are kept
+        in memory, and only read again when their modification time changes
+        """
         try:
             pattern_path = os.path.join(self.patterns_dir, pattern_name, 'system.md')
-            if os.path.exists(pattern_path):
-                with open(pattern_path, 'r', encoding='utf-8') as f:
-                    return f.read()
-            return f"Pattern {pattern_name} not found"
+            if not os.path.exists(pattern_path):
+                self.pattern_contents.pop(pattern_name, None)
+                return f"Pattern {pattern_name} not found"
+            mtime = os.stat(pattern_path).st_mtime_ns
+            cached = self.pattern_contents.get(pattern_name)
+            if cached is not None and cached[0] == mtime:
+                self.pattern_contents.move_to_end(pattern_name)
+                return cached[1]
+            with open(pattern_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            self.pattern_contents[pattern_name] = (mtime, content)
+            self.pattern_contents.move_to_end(pattern_name)
+            if len(self.pattern_contents) > PATTERN_CONTENT_CACHE_SIZE:
+                self.pattern_contents.popitem(last=False)
+            return content
         except Exception as e:
             logging.error(f"Failed to read pattern {pattern_name}: {str(e)}")
             return f"Error loading pattern {pattern_name}: {str(e)}"
@@ -96,11 +129,15 @@ class PatternPlugin(Plugin):
     def get_source_name(self) -> str:
         return "PatternPlugin"
 
+    def specs_changed(self) -> bool:
+        return self.get_available_patterns() != self.spec_patterns
+
     def get_spec(self) -> [Dict]:
         """
         Define the function specs for the pattern plugin.
         """
         patterns = self.get_available_patterns()
+        self.spec_patterns = patterns
         
         specs = [{
             "name": "list_patterns",
@@ -1,12 +1,17 @@
 from abc import abstractmethod, ABC
 from typing import Dict
 
+import httpx
+
 
 class Plugin(ABC):
     """
     A plugin interface which can be used to create plugins for the ChatGPT API.
     """
 
+    # The HTTP client shared by all plugins, set by the PluginManager
+    http_client: httpx.AsyncClient = None
+
     @abstractmethod
     def get_source_name(self) -> str:
         """
@@ -22,6 +27,13 @@ class Plugin(ABC):
         """
         pass
 
+    def specs_changed(self) -> bool:
+        """
+        Return whether get_spec would return different specs than at its last call, e.g. because
+        patterns were added. Called periodically outside the event loop, so it may read files
+        """
+        return False
+
     @abstractmethod
     async def execute(self, function_name, helper, **kwargs) -> Dict:
         """
@@ -1,5 +1,5 @@
 import logging
-import requests
+import httpx
 from typing import Dict
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse
@@ -39,7 +39,7 @@ class URLSummarizePlugin(Plugin):
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
-            response = requests.get(url, headers=headers, timeout=15)
+            response = await self.http_client.get(url, headers=headers, timeout=15)
             response.raise_for_status()  # Raise exception for 4XX/5XX responses
             
             # Parse the HTML content
@@ -76,7 +76,7 @@ class URLSummarizePlugin(Plugin):
                 }
             }
             
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logging.warning(f"Error fetching URL {kwargs.get('url', 'unknown')}: {str(e)}")
             return {"result": f"Failed to access the website: {str(e)}"}
         except Exception as e:
@@ -1,4 +1,4 @@
-import os, requests, random, string
+import os, random, string
 from typing import Dict
 from .plugin import Plugin
 
@@ -31,10 +31,10 @@ class WebshotPlugin(Plugin):
             image_url = f'https://image.thum.io/get/maxAge/12/width/720/{kwargs["url"]}'
             
             # preload url first
-            requests.get(image_url)
+            await self.http_client.get(image_url)
 
             # download the actual image
-            response = requests.get(image_url, timeout=30)
+            response = await self.http_client.get(image_url, timeout=30)
 
             if response.status_code == 200:
                 if not os.path.exists("uploads/webshot"):
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Request priorities, lower values are sent first
+PRIORITY_FINAL = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_INTERMEDIATE = 2
+
+# Full group buckets are dropped once there are more than this many
+MAX_GROUP_BUCKETS = 1000
+
+# Prefixes of the endpoints posting or changing messages, the only ones counted against the group limit
+GROUP_LIMITED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+GROUP_UNLIMITED_ENDPOINTS = ('sendChatAction',)
+
+
+def is_group_limited(endpoint: str) -> bool:
+    """
+    Checks if requests to the endpoint count against the per-group limit, which only applies to messages.
+    """
+    return endpoint.startswith(GROUP_LIMITED_PREFIXES) and endpoint not in GROUP_UNLIMITED_ENDPOINTS
+
+
+class TokenBucket:
+    """
+    A token bucket holding up to `capacity` tokens, refilled at `rate` tokens per second.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.refilled_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def wait_time(self) -> float:
+        """
+        Gets the number of seconds until a token is available, as of the last refill.
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Empties the bucket so that the next token is only available after the given number of seconds.
+        """
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class TelegramRateLimiter(BaseRateLimiter[dict]):
+    """
+    Throttles all requests to the Telegram Bot API so that they stay within the overall and
+    per-group flood limits, instead of hitting them and backing off. Pending requests are sent
+    by priority, then in arrival order, so final messages overtake intermediate stream edits.
+
+    Requests can pass rate_limit_args={'priority': ..., 'key': ...}. A request that is still
+    waiting when a newer request with the same key is queued is dropped.
+    """
+
+    def __init__(self, overall_rate: float, group_rate_per_minute: float, max_retries: int = 3):
+        """
+        :param overall_rate: Maximum number of requests per second over all chats
+        :param group_rate_per_minute: Maximum number of requests per minute to the same group
+        :param max_retries: Number of times a request is retried after a flood control error
+        """
+        self.overall = TokenBucket(overall_rate, overall_rate)
+        self.group_rate = group_rate_per_minute / 60
+        self.groups: dict[int | str, TokenBucket] = {}
+        self.max_retries = max_retries
+        self.waiters: list[list] = []  # heap of [priority, arrival, key, group_id, future]
+        self.latest: dict[Any, int] = {}  # {key: arrival of the newest request with that key}
+        self.arrivals = itertools.count()
+        self.wakeup: asyncio.TimerHandle | None = None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+            self.wakeup = None
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, dict, list[dict]]]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: dict | None,
+    ) -> Union[bool, dict, list[dict]]:
+        rate_limit_args = rate_limit_args or {}
+        priority = rate_limit_args.get('priority', PRIORITY_DEFAULT)
+        key = rate_limit_args.get('key')
+        chat_id = data.get('chat_id')
+        # Group chat IDs are negative, channels and public groups can also be given by username
+        is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+        group_id = chat_id if is_group and is_group_limited(endpoint) else None
+
+        retries = 0
+        while True:
+            if not await self.__acquire(priority, key, group_id):
+                logging.debug(f'Dropping superseded {endpoint} request')
+                return True
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                logging.warning(f'Flood control exceeded for {endpoint}, retrying in {e.retry_after}s')
+                if group_id is not None:
+                    self.__group_bucket(group_id).pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+
+    async def __acquire(self, priority: int, key: Any, group_id: int | str | None) -> bool:
+        """
+        Waits until the request can be sent.
+        :return: False if the request was superseded by a newer one with the same key
+        """
+        arrival = next(self.arrivals)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, [priority, arrival, key, group_id, future])
+        if key is not None:
+            self.latest[key] = arrival
+        self.__dispatch()
+        try:
+            return await future
+        finally:
+            if key is not None and self.latest.get(key) == arrival:
+                del self.latest[key]
+
+    def __group_bucket(self, group_id: int | str) -> TokenBucket:
+        if group_id not in self.groups:
+            if len(self.groups) >= MAX_GROUP_BUCKETS:
+                self.__prune_group_buckets()
+            # Allow short bursts, e.g. finishing a message and starting the next one
+            self.groups[group_id] = TokenBucket(self.group_rate, 3)
+        return self.groups[group_id]
+
+    def __prune_group_buckets(self):
+        now = time.monotonic()
+        for group_id, bucket in list(self.groups.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.groups[group_id]
+
+    def __dispatch(self):
+        """
+        Lets the waiting requests that fit in the limits through, in priority order.
+        Requests to a group that reached its limit do not hold back requests to other chats.
+        """
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+            self.wakeup = None
+        now = time.monotonic()
+        self.overall.refill(now)
+
+        blocked = []
+        next_dispatch = None
+        while self.waiters:
+            waiter = heapq.heappop(self.waiters)
+            _, arrival, key, group_id, future = waiter
+            if future.done():
+                # Cancelled while waiting
+                continue
+            if key is not None and self.latest.get(key) != arrival:
+                future.set_result(False)
+                continue
+
+            group = self.__group_bucket(group_id) if group_id is not None else None
+            if group is not None:
+                group.refill(now)
+                if group.tokens < 1:
+                    blocked.append(waiter)
+                    next_dispatch = min(next_dispatch, group.wait_time()) if next_dispatch is not None \
+                        else group.wait_time()
+                    continue
+            if self.overall.tokens < 1:
+                blocked.append(waiter)
+                next_dispatch = min(next_dispatch, self.overall.wait_time()) if next_dispatch is not None \
+                    else self.overall.wait_time()
+                break
+
+            self.overall.tokens -= 1
+            if group is not None:
+                group.tokens -= 1
+            future.set_result(True)
+
+        for waiter in blocked:
+            heapq.heappush(self.waiters, waiter)
+        if next_dispatch is not None:
+            self.wakeup = asyncio.get_running_loop().call_later(next_dispatch, self.__dispatch)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import datetime
+import email.utils
+import logging
+import random
+import re
+
+import openai
+from tenacity import AsyncRetrying, RetryCallState, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from tenacity.wait import wait_base
+
+# Durations of the x-ratelimit-reset-* headers, e.g. '1s', '6m0s' or '20ms'
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Checks if a failed OpenAI request is worth retrying: rate limits, timeouts,
+    connection errors and server errors, but not an exhausted quota.
+    :param error: The error raised by the request
+    :return: Boolean indicating if the request should be retried
+    """
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.RateLimitError):
+        return error.code != 'insufficient_quota'
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+
+def parse_duration(value: str) -> float | None:
+    """
+    Parses a duration such as '6m0s' into seconds.
+    """
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after(error: BaseException) -> float | None:
+    """
+    Gets the number of seconds the server asked to wait before retrying, from the retry-after
+    headers or the reset time of the exhausted rate limits.
+    :param error: The error raised by the request
+    :return: The number of seconds to wait, or None if the server did not say
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            # Can also be an HTTP date
+            try:
+                retry_date = email.utils.parsedate_to_datetime(headers['retry-after'])
+                return (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+
+    resets = [parse_duration(headers[f'x-ratelimit-reset-{kind}']) for kind in ('requests', 'tokens')
+              if headers.get(f'x-ratelimit-remaining-{kind}') == '0' and f'x-ratelimit-reset-{kind}' in headers]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class wait_retry_after(wait_base):
+    """
+    Waits as long as the server asked for, with a little jitter, and falls back
+    to jittered exponential backoff when it did not say.
+    """
+
+    def __init__(self, max_wait: float):
+        self.max_wait = max_wait
+        self.backoff = wait_exponential_jitter(initial=1, max=max_wait)
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        delay = retry_after(retry_state.outcome.exception())
+        if delay is None:
+            return self.backoff(retry_state)
+        return min(max(delay, 0) + random.uniform(0, 0.5), self.max_wait)
+
+
+def log_retry(retry_state: RetryCallState):
+    logging.warning(f'OpenAI request failed: {str(retry_state.outcome.exception())}. '
+                    f'Retrying in {retry_state.next_action.sleep:.1f}s '
+                    f'(attempt {retry_state.attempt_number + 1})...')
+
+
+async def call_with_retry(call, max_attempts: int, max_wait: float):
+    """
+    Awaits an OpenAI request, retrying it on transient errors.
+    :param call: A function returning a new awaitable of the request on each call
+    :param max_attempts: The maximum number of attempts
+    :param max_wait: The maximum number of seconds to wait between attempts
+    :return: The result of the request
+    """
+    async for attempt in AsyncRetrying(reraise=True,
+                                       retry=retry_if_exception(is_transient_error),
+                                       wait=wait_retry_after(max_wait),
+                                       stop=stop_after_attempt(max_attempts),
+                                       before_sleep=log_retry):
+        with attempt:
+            return await call()
@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import signal
+
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, ContextTypes, TypeHandler
+
+from telegram_bot import run_application
+from utils import setup_logging
+
+# Number of points of each worker on the hash ring
+VIRTUAL_NODES = 100
+
+# Seconds to wait for a worker to finish its updates on shutdown
+WORKER_SHUTDOWN_TIMEOUT = 30
+
+
+def stable_hash(value: str) -> int:
+    """
+    Hashes a string the same way in every process, unlike hash() which is salted per process.
+    """
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    A consistent hash ring assigning keys to workers. Each worker owns many points on the ring,
+    so keys are spread evenly, and changing the number of workers only moves the keys of the
+    workers that were added or removed.
+    """
+
+    def __init__(self, workers: int, virtual_nodes: int = VIRTUAL_NODES):
+        """
+        :param workers: The number of workers
+        :param virtual_nodes: The number of points of each worker on the ring
+        """
+        self.points = sorted((stable_hash(f'{worker}:{node}'), worker)
+                             for worker in range(workers) for node in range(virtual_nodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def get(self, key) -> int:
+        """
+        Gets the worker owning the given key.
+        :param key: The key, e.g. a chat ID
+        :return: The index of the worker
+        """
+        index = bisect.bisect(self.hashes, stable_hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+
+def shard_key(update: Update) -> int | None:
+    """
+    Gets the key deciding which worker handles an update: the chat ID, or the user ID for updates
+    without a chat such as inline queries, which matches the user's private chat.
+    """
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+def worker_configs(openai_config: dict, telegram_config: dict, workers: int) -> tuple[dict, dict]:
+    """
+    Splits the global limits evenly between the workers, so that together they stay within them.
+    Each worker gets at least 1 of each limit, and limits of 0 stay unlimited.
+    :return: The OpenAI and Telegram configurations of each worker
+    """
+    openai_config = dict(openai_config)
+    openai_config['workers'] = workers
+    for key in ('max_concurrent_requests', 'tokens_per_minute',
+                'max_conversations_in_memory', 'max_conversations_memory_mb'):
+        if openai_config[key] > 0:
+            openai_config[key] = max(1, openai_config[key] // workers)
+    telegram_config = dict(telegram_config)
+    telegram_config['telegram_rate_limit'] = telegram_config['telegram_rate_limit'] / workers
+    return openai_config, telegram_config
+
+
+def run_worker(index: int, create_bot, updates: multiprocessing.Queue):
+    """
+    Entry point of a worker process: handles the updates forwarded by the front process.
+    :param index: The index of the worker
+    :param create_bot: A function creating the bot and its conversation store
+    :param updates: The queue the updates of the worker are forwarded to
+    """
+    # Ctrl+C is handled by the front process, which then stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+    telegram_bot, conversation_store = create_bot()
+    try:
+        asyncio.run(serve_worker(index, telegram_bot.build_application(), updates))
+    finally:
+        conversation_store.close()
+
+
+async def serve_worker(index: int, application: Application, updates: multiprocessing.Queue):
+    """
+    Runs the application of a worker, feeding it the updates read from the queue until it reads None.
+    """
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    logging.info(f'Worker {index} started')
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown is not None:
+            await application.post_shutdown(application)
+        logging.info(f'Worker {index} stopped')
+
+
+class Worker:
+    """
+    A worker process and the queue its updates are forwarded to.
+    """
+
+    def __init__(self, index: int, create_bot):
+        self.index = index
+        self.create_bot = create_bot
+        self.updates = multiprocessing.Queue()
+        self.process: multiprocessing.Process | None = None
+
+    def start(self):
+        self.process = multiprocessing.Process(target=run_worker, name=f'worker-{self.index}',
+                                               args=(self.index, self.create_bot, self.updates))
+        self.process.start()
+
+    def forward(self, data: dict):
+        if not self.process.is_alive():
+            logging.error(f'Worker {self.index} exited with code {self.process.exitcode}, restarting it')
+            self.start()
+        self.updates.put(data)
+
+    def stop(self):
+        if self.process.is_alive():
+            self.updates.put(None)
+        self.process.join(WORKER_SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            logging.warning(f'Worker {self.index} did not stop in time, terminating it')
+            self.process.terminate()
+            self.process.join()
+
+
+def run_sharded(create_bot, telegram_config: dict, workers: int):
+    """
+    Runs the bot as a front process receiving the updates and several worker processes handling
+    them. Each update is forwarded to a worker by consistent hashing of its chat, so the state of a
+    chat (conversation, locks, pending prompts) stays in one worker, while token counting, image
+    conversion and serialization are spread over the CPU cores.
+    :param create_bot: A function creating the bot and its conversation store, called in each worker.
+                       It must be picklable, e.g. a module level function or a partial of one
+    :param telegram_config: The Telegram configuration
+    :param workers: The number of worker processes
+    """
+    ring = HashRing(workers)
+    pool = [Worker(index, create_bot) for index in range(workers)]
+    for worker in pool:
+        worker.start()
+
+    async def forward(update: Update, _: ContextTypes.DEFAULT_TYPE):
+        key = shard_key(update)
+        pool[ring.get(key) if key is not None else 0].forward(update.to_dict())
+
+    application = ApplicationBuilder() \
+        .token(telegram_config['token']) \
+        .proxy_url(telegram_config['proxy']) \
+        .get_updates_proxy_url(telegram_config['proxy']) \
+        .build()
+    application.add_handler(TypeHandler(Update, forward))
+
+    logging.info(f'Dispatching updates to {workers} workers')
+    try:
+        run_application(application, telegram_config)
+    finally:
+        for worker in pool:
+            worker.stop()
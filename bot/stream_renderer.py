@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from telegram import Message, Update, constants
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import ContextTypes
+
+from rate_limiter import PRIORITY_FINAL, PRIORITY_INTERMEDIATE
+from utils import edit_message_with_retry, get_thread_id, split_complete_chunks, split_into_chunks, utf16_length
+
+# Give up on an edit after this many consecutive failures
+MAX_FAILURES = 3
+
+
+class StreamRenderer:
+    """
+    Renders a streamed answer into Telegram messages. The parts pushed while an edit is in flight
+    or before the edit interval has elapsed are coalesced, so there is at most one edit per interval
+    and edits never overlap. The final text is always rendered, with markdown. Answers longer than
+    a Telegram message are continued in new messages, except inline messages which are truncated.
+    The messages left over when the final text needs fewer pages than the streamed one are deleted.
+
+    The streamed text is kept as the list of complete pages plus the parts of the current page,
+    so each edit only joins the current page instead of the whole answer.
+    """
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, interval: float,
+                 reply_to_message_id: int = None, inline_message_id: str = None, format_text=None):
+        """
+        :param update: The update being answered
+        :param context: The context to use
+        :param interval: The minimum number of seconds between two edits
+        :param reply_to_message_id: The message the first message replies to, if any
+        :param inline_message_id: The inline message to edit, if the answer is rendered inline
+        :param format_text: A function formatting the text and a markdown flag into the inline message text
+        """
+        self.update = update
+        self.context = context
+        self.interval = interval
+        self.reply_to_message_id = reply_to_message_id
+        self.inline_message_id = inline_message_id
+        self.format_text = format_text or (lambda text, markdown: text)
+        self.complete_pages: list[str] = []
+        self.current_parts: list[str] = []
+        self.current_length = 0
+        self.final_pages: list[str] | None = None
+        self.has_content = False
+        self.version = 0  # incremented whenever there is something new to render
+        self.rendered_version = 0
+        self.messages: list[Message] = []
+        self.pages: list[tuple[str, bool]] = []  # [(text, markdown)] as rendered in each message
+        self.next_edit_at = 0.0
+        self.task: asyncio.Task | None = None
+
+    def push(self, part: str):
+        """
+        Appends a streamed part of the answer. It is rendered at the next edit.
+        :param part: The new part of the answer
+        """
+        if len(part) == 0:
+            return
+        self.current_parts.append(part)
+        self.current_length += utf16_length(part)
+        if self.current_length > 4096:
+            # Complete the current page and carry the rest over to the next one, unsplit so that
+            # the next parts are appended to it as they were streamed
+            pages, remainder = split_complete_chunks(''.join(self.current_parts))
+            self.complete_pages.extend(pages)
+            self.current_parts = [remainder]
+            self.current_length = utf16_length(remainder)
+
+        self.has_content = self.has_content or len(part.strip()) > 0
+        if self.has_content:
+            self.version += 1
+            self.__ensure_rendering()
+
+    async def finish(self, text: str):
+        """
+        Sets the final text, which replaces the streamed parts, and waits until it is rendered.
+        :param text: The final text
+        """
+        if len(text.strip()) > 0:
+            self.final_pages = split_into_chunks(text)
+            self.has_content = True
+        if not self.has_content:
+            return
+        self.version += 1
+        self.__ensure_rendering()
+        await self.task
+
+    def __ensure_rendering(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.__render_loop())
+
+    async def __render_loop(self):
+        """
+        Renders the latest text once per interval until it is up to date.
+        """
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while not self.__is_up_to_date():
+            delay = self.next_edit_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            version, final = self.version, self.final_pages is not None
+            pages = self.final_pages if final else self.complete_pages + [''.join(self.current_parts)]
+            if len(pages) > 1 and len(pages[-1].strip()) == 0:
+                # Telegram rejects blank messages, start the next page once it has some text
+                pages = pages[:-1]
+            try:
+                await self.__render(pages, markdown=final)
+                self.rendered_version = version
+                failures = 0
+            except RetryAfter as e:
+                logging.warning(f'Flood control exceeded while streaming, retrying in {e.retry_after}s')
+                self.interval *= 2
+                self.next_edit_at = loop.time() + e.retry_after
+                continue
+            except Exception as e:
+                failures += 1
+                logging.warning(f'Failed to render streamed answer: {str(e)}')
+                if failures >= MAX_FAILURES:
+                    return
+            self.next_edit_at = loop.time() + self.interval
+
+    def __is_up_to_date(self) -> bool:
+        return self.rendered_version == self.version
+
+    async def __render(self, pages: list[str], markdown: bool):
+        """
+        Edits or sends the messages needed to show the given pages.
+        """
+        if self.inline_message_id is not None:
+            # Inline messages cannot be continued, only the first page is shown
+            await edit_message_with_retry(self.context, chat_id=None, message_id=self.inline_message_id,
+                                          text=split_into_chunks(self.format_text(pages[0], markdown))[0], markdown=markdown,
+                                          is_inline=True,
+                                          rate_limit_args=self.__rate_limit_args(self.inline_message_id, markdown))
+            return
+
+        for index, page in enumerate(pages):
+            # Pages followed by another one are complete and can be rendered with markdown
+            page_markdown = markdown or index < len(pages) - 1
+            if index < len(self.messages):
+                if self.pages[index] != (page, page_markdown):
+                    message = self.messages[index]
+                    await edit_message_with_retry(self.context, message.chat_id, str(message.message_id), page,
+                                                  markdown=page_markdown,
+                                                  rate_limit_args=self.__rate_limit_args(
+                                                      (message.chat_id, message.message_id), page_markdown))
+            else:
+                self.messages.append(await self.__send(page, page_markdown, index))
+                self.pages.append((page, page_markdown))
+            self.pages[index] = (page, page_markdown)
+
+        while len(self.messages) > len(pages):
+            await self.__delete(self.messages[-1])
+            self.messages.pop()
+            self.pages.pop()
+
+    @staticmethod
+    def __rate_limit_args(message_key, final: bool) -> dict:
+        """
+        Gets the rate limiter arguments of an edit: complete texts are sent before intermediate ones,
+        and an intermediate edit still waiting to be sent is replaced by the next edit of the message.
+        """
+        return {'priority': PRIORITY_FINAL if final else PRIORITY_INTERMEDIATE, 'key': ('edit', message_key)}
+
+    async def __delete(self, message: Message):
+        """
+        Deletes a message that is no longer needed.
+        """
+        try:
+            await self.context.bot.delete_message(chat_id=message.chat_id, message_id=message.message_id,
+                                                  rate_limit_args={'priority': PRIORITY_FINAL})
+        except Exception as e:
+            logging.warning(f'Failed to delete surplus streamed message: {str(e)}')
+
+    async def __send(self, text: str, markdown: bool, index: int) -> Message:
+        """
+        Sends a new message for the page at the given index.
+        """
+        args = {
+            'chat_id': self.update.effective_chat.id,
+            'message_thread_id': get_thread_id(self.update),
+            'reply_to_message_id': self.reply_to_message_id if index == 0 else None,
+            'text': text,
+            'rate_limit_args': {'priority': PRIORITY_FINAL},
+        }
+        if markdown:
+            try:
+                return await self.context.bot.send_message(**args, parse_mode=constants.ParseMode.MARKDOWN)
+            except BadRequest:
+                pass
+        return await self.context.bot.send_message(**args)
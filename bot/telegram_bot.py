@@ -1,27 +1,33 @@
 from __future__ import annotations
 
 import asyncio
+import datetime
 import logging
+import sys
 import os
 import io
 
 from uuid import uuid4
-from telegram import BotCommandScopeAllGroupChats, Update, constants
+from telegram import BotCommandScopeAllGroupChats, ChatMember, Update, constants
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle
 from telegram import InputTextMessageContent, BotCommand
-from telegram.error import RetryAfter, TimedOut, BadRequest
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
-    filters, InlineQueryHandler, CallbackQueryHandler, Application, ContextTypes, CallbackContext
+    filters, InlineQueryHandler, CallbackQueryHandler, ChatMemberHandler, Application, ContextTypes, CallbackContext
 
 from pydub import AudioSegment
 from PIL import Image
 
 from utils import is_group_chat, get_thread_id, message_text, wrap_with_indicator, split_into_chunks, \
-    edit_message_with_retry, get_stream_cutoff_values, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
+    edit_message_with_retry, get_stream_edit_interval, is_allowed, get_remaining_budget, is_admin, is_within_budget, \
     get_reply_to_message_id, add_chat_request_to_usage_tracker, error_handler, is_direct_result, handle_direct_result, \
-    cleanup_intermediate_files
+    cleanup_intermediate_files, get_user_budget
+from chat_locks import ChatLocks
+from group_membership import GroupMembershipCache
+from stream_renderer import StreamRenderer
+from rate_limiter import TelegramRateLimiter
 from openai_helper import OpenAIHelper, localized_text
-from usage_tracker import UsageTracker
+from usage_tracker import create_usage_trackers
 
 
 class ChatGPTTelegramBot:
@@ -56,9 +62,17 @@ class ChatGPTTelegramBot:
         )] + self.commands
         self.disallowed_message = localized_text('disallowed', bot_language)
         self.budget_limit_message = localized_text('budget_limit', bot_language)
-        self.usage = {}
-        self.last_message = {}
-        self.inline_queries_cache = {}
+        self.usage = create_usage_trackers(config)
+        self.last_message = {}  # {chat_id: (prompt, received at)}
+        self.inline_queries_cache = {}  # {result_id: (query, received at)}
+        # {(user_id, chat_id): (allowed, within budget, expires at, usage tracker of the budget, its version)}
+        self.access_decisions = {}
+        self.memberships = GroupMembershipCache(config['group_membership_ttl_minutes'] * 60)
+        self.sweeper = None
+        self.plugin_watcher = None
+        self.usage_flusher = None
+        self.usage_flush: asyncio.Future | None = None  # the latest flush, which may still be writing
+        self.chat_locks = ChatLocks()
 
     async def send_processing_message(self, update: Update, function_name: str = None) -> Message:
         """
@@ -111,7 +125,7 @@ class ChatGPTTelegramBot:
         """
         Returns token usage statistics for current day and month.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, memberships=self.memberships):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             'is not allowed to request their usage statistics')
             await self.send_disallowed_message(update, context)
@@ -121,8 +135,7 @@ class ChatGPTTelegramBot:
                      'requested their usage statistics')
 
         user_id = update.message.from_user.id
-        if user_id not in self.usage:
-            self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+        self.usage.tracker(user_id, update.message.from_user.name)
 
         tokens_today, tokens_month = self.usage[user_id].get_current_token_usage()
         images_today, images_month = self.usage[user_id].get_current_image_count()
@@ -217,7 +230,7 @@ class ChatGPTTelegramBot:
         """
         Resend the last request
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, memberships=self.memberships):
             logging.warning(f'User {update.message.from_user.name}  (id: {update.message.from_user.id})'
                             ' is not allowed to resend the message')
             await self.send_disallowed_message(update, context)
@@ -237,7 +250,7 @@ class ChatGPTTelegramBot:
         logging.info(f'Resending the last prompt from user: {update.message.from_user.name} '
                      f'(id: {update.message.from_user.id})')
         with update.message._unfrozen() as message:
-            message.text = self.last_message.pop(chat_id)
+            message.text, _ = self.last_message.pop(chat_id)
 
         await self.prompt(update=update, context=context)
 
@@ -245,7 +258,7 @@ class ChatGPTTelegramBot:
         """
         Resets the conversation.
         """
-        if not await is_allowed(self.config, update, context):
+        if not await is_allowed(self.config, update, context, memberships=self.memberships):
             logging.warning(f'User {update.message.from_user.name} (id: {update.message.from_user.id}) '
                             'is not allowed to reset the conversation')
             await self.send_disallowed_message(update, context)
@@ -311,7 +324,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_image_request(image_size, self.config['image_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                     self.usage["guests"].add_image_request(image_size, self.config['image_prices'])
 
             except Exception as e:
@@ -374,7 +387,7 @@ class ChatGPTTelegramBot:
                 user_id = update.message.from_user.id
                 self.usage[user_id].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
                 # add guest chat request to guest usage tracker
-                if str(user_id) not in self.config['allowed_user_ids'].split(',') and 'guests' in self.usage:
+                if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                     self.usage["guests"].add_tts_request(text_length, self.config['tts_model'], self.config['tts_prices'])
 
             except Exception as e:
@@ -456,8 +469,7 @@ class ChatGPTTelegramBot:
                 logging.warning(f"Failed to delete processing message: {str(e)}")
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            self.usage.tracker(user_id, update.message.from_user.name)
 
             try:
                 transcript = await self.openai.transcribe(filename_mp3)
@@ -465,8 +477,7 @@ class ChatGPTTelegramBot:
                 transcription_price = self.config['transcription_price']
                 self.usage[user_id].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
-                allowed_user_ids = self.config['allowed_user_ids'].split(',')
-                if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                     self.usage["guests"].add_transcription_seconds(audio_track.duration_seconds, transcription_price)
 
                 # check if transcript starts with any of the prefixes
@@ -491,7 +502,7 @@ class ChatGPTTelegramBot:
                     response, total_tokens = await self.openai.get_chat_response(chat_id=chat_id, query=transcript)
 
                     self.usage[user_id].add_chat_tokens(total_tokens, self.config['token_price'])
-                    if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+                    if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                         self.usage["guests"].add_chat_tokens(total_tokens, self.config['token_price'])
 
                     # Split into chunks of 4096 characters (Telegram's message limit)
@@ -598,89 +609,25 @@ class ChatGPTTelegramBot:
             
 
             user_id = update.message.from_user.id
-            if user_id not in self.usage:
-                self.usage[user_id] = UsageTracker(user_id, update.message.from_user.name)
+            self.usage.tracker(user_id, update.message.from_user.name)
 
             if self.config['stream']:
 
                 stream_response = self.openai.interpret_image_stream(chat_id=chat_id, fileobj=temp_file_png, prompt=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
+                renderer = StreamRenderer(update, context, get_stream_edit_interval(self.config, update),
+                                          reply_to_message_id=get_reply_to_message_id(self.config, update))
 
                 async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
+                    if tokens == 'not_finished':
+                        renderer.push(content)
                         continue
 
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
+                    if is_direct_result(content):
+                        return await handle_direct_result(self.config, update, content)
 
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                    total_tokens = int(tokens)
+                    await renderer.finish(content)
 
-                
             else:
 
                 try:
@@ -720,8 +667,7 @@ class ChatGPTTelegramBot:
             vision_token_price = self.config['vision_token_price']
             self.usage[user_id].add_vision_tokens(total_tokens, vision_token_price)
 
-            allowed_user_ids = self.config['allowed_user_ids'].split(',')
-            if str(user_id) not in allowed_user_ids and 'guests' in self.usage:
+            if str(user_id) not in self.config['allowed_user_id_set'] and 'guests' in self.usage:
                 self.usage["guests"].add_vision_tokens(total_tokens, vision_token_price)
 
         await wrap_with_indicator(update, context, _execute, constants.ChatAction.TYPING)
@@ -741,7 +687,7 @@ class ChatGPTTelegramBot:
         chat_id = update.effective_chat.id
         user_id = update.message.from_user.id
         prompt = message_text(update.message)
-        self.last_message[chat_id] = prompt
+        self.last_message[chat_id] = (prompt, datetime.datetime.now())
 
         if is_group_chat(update):
             trigger_keyword = self.config['group_trigger_keyword']
@@ -773,11 +719,8 @@ class ChatGPTTelegramBot:
                 )
 
                 stream_response = self.openai.get_chat_response_stream(chat_id=chat_id, query=prompt)
-                i = 0
-                prev = ''
-                sent_message = None
-                backoff = 0
-                stream_chunk = 0
+                renderer = StreamRenderer(update, context, get_stream_edit_interval(self.config, update),
+                                          reply_to_message_id=get_reply_to_message_id(self.config, update))
 
                 # Delete the processing message once we start getting responses
                 try:
@@ -787,74 +730,15 @@ class ChatGPTTelegramBot:
                     logging.warning(f"Failed to delete processing message: {str(e)}")
 
                 async for content, tokens in stream_response:
-                    if is_direct_result(content):
-                        return await handle_direct_result(self.config, update, content)
-
-                    if len(content.strip()) == 0:
+                    if tokens == 'not_finished':
+                        renderer.push(content)
                         continue
 
-                    stream_chunks = split_into_chunks(content)
-                    if len(stream_chunks) > 1:
-                        content = stream_chunks[-1]
-                        if stream_chunk != len(stream_chunks) - 1:
-                            stream_chunk += 1
-                            try:
-                                await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                              stream_chunks[-2])
-                            except:
-                                pass
-                            try:
-                                sent_message = await update.effective_message.reply_text(
-                                    message_thread_id=get_thread_id(update),
-                                    text=content if len(content) > 0 else "..."
-                                )
-                            except:
-                                pass
-                            continue
-
-                    cutoff = get_stream_cutoff_values(update, content)
-                    cutoff += backoff
-
-                    if i == 0:
-                        try:
-                            if sent_message is not None:
-                                await context.bot.delete_message(chat_id=sent_message.chat_id,
-                                                                 message_id=sent_message.message_id)
-                            sent_message = await update.effective_message.reply_text(
-                                message_thread_id=get_thread_id(update),
-                                reply_to_message_id=get_reply_to_message_id(self.config, update),
-                                text=content,
-                            )
-                        except:
-                            continue
-
-                    elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                        prev = content
-
-                        try:
-                            use_markdown = tokens != 'not_finished'
-                            await edit_message_with_retry(context, chat_id, str(sent_message.message_id),
-                                                          text=content, markdown=use_markdown)
-
-                        except RetryAfter as e:
-                            backoff += 5
-                            await asyncio.sleep(e.retry_after)
-                            continue
-
-                        except TimedOut:
-                            backoff += 5
-                            await asyncio.sleep(0.5)
-                            continue
-
-                        except Exception:
-                            backoff += 5
-                            continue
-
-                        await asyncio.sleep(0.01)
+                    if is_direct_result(content):
+                        return await handle_direct_result(self.config, update, content)
 
-                    i += 1
-                    if tokens != 'not_finished':
-                        total_tokens = int(tokens)
+                    total_tokens = int(tokens)
+                    await renderer.finish(content)
 
             else:
                 async def _reply():
@@ -912,7 +796,7 @@ class ChatGPTTelegramBot:
 
         callback_data_suffix = "gpt:"
         result_id = str(uuid4())
-        self.inline_queries_cache[result_id] = query
+        self.inline_queries_cache[result_id] = (query, datetime.datetime.now())
         callback_data = f'{callback_data_suffix}{result_id}'
 
         await self.send_inline_query_result(update, result_id, message_content=query, callback_data=callback_data)
@@ -963,9 +847,8 @@ class ChatGPTTelegramBot:
                 total_tokens = 0
 
                 # Retrieve the prompt from the cache
-                query = self.inline_queries_cache.get(unique_id)
-                if query:
-                    self.inline_queries_cache.pop(unique_id)
+                if unique_id in self.inline_queries_cache:
+                    query, _ = self.inline_queries_cache.pop(unique_id)
                 else:
                     error_message = (
                         f'{localized_text("error", bot_language)}. '
@@ -979,10 +862,18 @@ class ChatGPTTelegramBot:
                 unavailable_message = localized_text("function_unavailable_in_inline_mode", bot_language)
                 if self.config['stream']:
                     stream_response = self.openai.get_chat_response_stream(chat_id=user_id, query=query)
-                    i = 0
-                    prev = ''
-                    backoff = 0
+
+                    def format_text(content, markdown):
+                        divider = '_' if markdown else ''
+                        return f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
+
+                    renderer = StreamRenderer(update, context, get_stream_edit_interval(self.config, update),
+                                              inline_message_id=inline_message_id, format_text=format_text)
                     async for content, tokens in stream_response:
+                        if tokens == 'not_finished':
+                            renderer.push(content)
+                            continue
+
                         if is_direct_result(content):
                             cleanup_intermediate_files(content)
                             await edit_message_with_retry(context, chat_id=None,
@@ -991,51 +882,8 @@ class ChatGPTTelegramBot:
                                                           is_inline=True)
                             return
 
-                        if len(content.strip()) == 0:
-                            continue
-
-                        cutoff = get_stream_cutoff_values(update, content)
-                        cutoff += backoff
-
-                        if i == 0:
-                            try:
-                                await edit_message_with_retry(context, chat_id=None,
-                                                              message_id=inline_message_id,
-                                                              text=f'{query}\n\n{answer_tr}:\n{content}',
-                                                              is_inline=True)
-                            except:
-                                continue
-
-                        elif abs(len(content) - len(prev)) > cutoff or tokens != 'not_finished':
-                            prev = content
-                            try:
-                                use_markdown = tokens != 'not_finished'
-                                divider = '_' if use_markdown else ''
-                                text = f'{query}\n\n{divider}{answer_tr}:{divider}\n{content}'
-
-                                # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                                text = text[:4096]
-
-                                await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
-                                                              text=text, markdown=use_markdown, is_inline=True)
-
-                            except RetryAfter as e:
-                                backoff += 5
-                                await asyncio.sleep(e.retry_after)
-                                continue
-                            except TimedOut:
-                                backoff += 5
-                                await asyncio.sleep(0.5)
-                                continue
-                            except Exception:
-                                backoff += 5
-                                continue
-
-                            await asyncio.sleep(0.01)
-
-                        i += 1
-                        if tokens != 'not_finished':
-                            total_tokens = int(tokens)
+                        total_tokens = int(tokens)
+                        await renderer.finish(content)
 
                 else:
                     async def _send_inline_query_response():
@@ -1058,8 +906,8 @@ class ChatGPTTelegramBot:
 
                         text_content = f'{query}\n\n_{answer_tr}:_\n{response}'
 
-                        # We only want to send the first 4096 characters. No chunking allowed in inline mode.
-                        text_content = text_content[:4096]
+                        # We only want to send the first chunk. No chunking allowed in inline mode.
+                        text_content = split_into_chunks(text_content)[0]
 
                         # Edit the original message with the generated content
                         await edit_message_with_retry(context, chat_id=None, message_id=inline_message_id,
@@ -1090,17 +938,54 @@ class ChatGPTTelegramBot:
         name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
         user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
 
-        if not await is_allowed(self.config, update, context, is_inline=is_inline):
+        allowed, within_budget = await self.access_decision(update, context, user_id, is_inline)
+        if not allowed:
             logging.warning(f'User {name} (id: {user_id}) is not allowed to use the bot')
             await self.send_disallowed_message(update, context, is_inline)
             return False
-        if not is_within_budget(self.config, self.usage, update, is_inline=is_inline):
+        if not within_budget:
             logging.warning(f'User {name} (id: {user_id}) reached their usage limit')
             await self.send_budget_reached_message(update, context, is_inline)
             return False
 
         return True
 
+    async def chat_member_updated(self, update: Update, _: ContextTypes.DEFAULT_TYPE):
+        """
+        Keeps the group membership cache up to date when users join or leave a group.
+        """
+        if update.my_chat_member is not None:
+            if update.my_chat_member.new_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED):
+                self.memberships.forget_chat(update.my_chat_member.chat.id)
+            return
+        self.memberships.on_chat_member_updated(update.chat_member)
+
+    async def access_decision(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                              is_inline: bool) -> tuple[bool, bool]:
+        """
+        Checks if the user is allowed to use the bot in the chat and is within their budget. The decision
+        is cached for a short time, until usage is recorded on the tracker the user's budget is taken from.
+        :return: Booleans indicating if the user is allowed and within their budget
+        """
+        chat_id = None if is_inline else update.effective_chat.id
+        now = datetime.datetime.now()
+        cached = self.access_decisions.get((user_id, chat_id))
+        if cached is not None:
+            allowed, within_budget, expires_at, tracker, version = cached
+            if now < expires_at and (tracker is None or tracker.version == version):
+                return allowed, within_budget
+
+        allowed = await is_allowed(self.config, update, context, is_inline=is_inline,
+                                   memberships=self.memberships)
+        within_budget = allowed and is_within_budget(self.config, self.usage, update, is_inline=is_inline)
+        ttl = self.config['access_cache_ttl_seconds']
+        if ttl > 0:
+            # Guests share the budget of the guests tracker, which only exists once a guest was allowed
+            tracker = self.usage.get(user_id if get_user_budget(self.config, user_id) is not None else 'guests')
+            self.access_decisions[(user_id, chat_id)] = (allowed, within_budget, now + datetime.timedelta(seconds=ttl),
+                                                         tracker, tracker.version if tracker is not None else None)
+        return allowed, within_budget
+
     async def send_disallowed_message(self, update: Update, _: ContextTypes.DEFAULT_TYPE, is_inline=False):
         """
         Sends the disallowed message to the user.
@@ -1128,48 +1013,225 @@ class ChatGPTTelegramBot:
             result_id = str(uuid4())
             await self.send_inline_query_result(update, result_id, message_content=self.budget_limit_message)
 
+    def sweep(self) -> int:
+        """
+        Evicts expired conversations, resend prompts older than the maximum conversation age
+        and inline queries that were not answered within the inline query TTL. Also logs the
+        chats that have updates queued, to spot chats sending faster than they are answered.
+        :return: The estimated number of bytes reclaimed
+        """
+        now = datetime.datetime.now()
+        conversations, reclaimed = self.openai.remove_expired_conversations()
+
+        max_age = datetime.timedelta(minutes=self.config['max_conversation_age_minutes'])
+        stale_messages = [chat_id for chat_id, (_, received_at) in self.last_message.items()
+                          if received_at < now - max_age]
+        for chat_id in stale_messages:
+            prompt, _ = self.last_message.pop(chat_id)
+            reclaimed += sys.getsizeof(prompt)
+
+        inline_query_ttl = datetime.timedelta(minutes=self.config['inline_query_ttl_minutes'])
+        stale_queries = [result_id for result_id, (_, received_at) in self.inline_queries_cache.items()
+                         if received_at < now - inline_query_ttl]
+        for result_id in stale_queries:
+            query, _ = self.inline_queries_cache.pop(result_id)
+            reclaimed += sys.getsizeof(result_id) + sys.getsizeof(query)
+
+        expired_decisions = [key for key, (_, _, expires_at, _, _) in self.access_decisions.items()
+                             if expires_at < now]
+        for key in expired_decisions:
+            del self.access_decisions[key]
+        self.memberships.prune()
+
+        if conversations or stale_messages or stale_queries:
+            logging.info(f'Swept {conversations} expired conversations, {len(stale_messages)} resend prompts '
+                         f'and {len(stale_queries)} inline queries, reclaiming ~{reclaimed} bytes')
+
+        queue_depths = self.chat_locks.queue_depths()
+        if queue_depths:
+            busiest = max(queue_depths, key=queue_depths.get)
+            logging.info(f'{len(queue_depths)} chats have updates in progress, '
+                         f'{sum(queue_depths.values())} in total, the most in chat {busiest} ({queue_depths[busiest]})')
+        return reclaimed
+
+    async def run_sweeper(self):
+        """
+        Periodically runs the sweep until cancelled.
+        """
+        interval = self.config['sweep_interval_minutes'] * 60
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logging.warning(f'Failed to sweep expired state: {str(e)}')
+
+    async def run_plugin_watcher(self):
+        """
+        Periodically checks the plugins for changes to their function specs, such as new patterns,
+        until cancelled, and reloads the specs when there are any. The check runs in another thread,
+        as it reads the file system.
+        """
+        interval = self.config['plugin_check_interval_seconds']
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.get_running_loop().run_in_executor(None, self.openai.plugin_manager.specs_changed):
+                    self.openai.plugin_manager.reload()
+                    logging.info('Reloaded the plugin specs')
+            except Exception as e:
+                logging.warning(f'Failed to check the plugins for changes: {str(e)}')
+
+    async def run_usage_flusher(self):
+        """
+        Periodically writes the changed usage files until cancelled, so that recording usage
+        does no disk I/O and a user file is written at most once per interval.
+        """
+        interval = self.config['usage_flush_interval_seconds']
+        while True:
+            await asyncio.sleep(interval)
+            # Shielded, so that cancelling the flusher does not abandon a write that has started
+            self.usage_flush = asyncio.ensure_future(self.usage.flush())
+            try:
+                await asyncio.shield(self.usage_flush)
+            except Exception as e:
+                logging.warning(f'Failed to flush usage: {str(e)}')
+
     async def post_init(self, application: Application) -> None:
         """
         Post initialization hook for the bot.
         """
         await application.bot.set_my_commands(self.group_commands, scope=BotCommandScopeAllGroupChats())
         await application.bot.set_my_commands(self.commands)
+        if self.config['sweep_interval_minutes'] > 0:
+            self.sweeper = asyncio.create_task(self.run_sweeper())
+        if self.config['plugin_check_interval_seconds'] > 0:
+            self.plugin_watcher = asyncio.create_task(self.run_plugin_watcher())
+        self.usage_flusher = asyncio.create_task(self.run_usage_flusher())
+
+    async def post_shutdown(self, application: Application) -> None:
+        """
+        Post shutdown hook for the bot.
+        """
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+        if self.plugin_watcher is not None:
+            self.plugin_watcher.cancel()
+        if self.usage_flusher is not None:
+            self.usage_flusher.cancel()
+        await self.openai.cancel_background_summaries()
+        if self.usage_flush is not None and not self.usage_flush.done():
+            # Let the write in progress finish, so that close() does not write the same files at the same time
+            try:
+                await self.usage_flush
+            except Exception as e:
+                logging.warning(f'Failed to flush usage: {str(e)}')
+        self.usage.close()
+        await self.openai.plugin_manager.close()
+
+    def serialised(self, handler):
+        """
+        Wraps an update handler so that the updates of a chat are handled one at a time, in order,
+        while updates of different chats are still handled concurrently.
+        :param handler: The update handler
+        :return: The wrapped update handler
+        """
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            # Inline messages have no chat, their conversation is keyed by the user ID
+            chat_id = update.effective_chat.id if update.effective_chat else update.effective_user.id
+            queued = self.chat_locks.queue_depth(chat_id)
+            if queued > 0:
+                logging.info(f'Chat {chat_id} has {queued} updates in progress, queueing the new one')
+            async with self.chat_locks.hold(chat_id):
+                await handler(update, context)
+        return wrapper
 
     def run(self):
         """
         Runs the bot indefinitely until the user presses Ctrl+C
         """
+        run_application(self.build_application(), self.config)
+
+    def build_application(self) -> Application:
+        """
+        Builds the application handling the updates of the bot.
+        """
         application = ApplicationBuilder() \
             .token(self.config['token']) \
             .proxy_url(self.config['proxy']) \
             .get_updates_proxy_url(self.config['proxy']) \
             .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown) \
             .concurrent_updates(True) \
+            .rate_limiter(TelegramRateLimiter(self.config['telegram_rate_limit'],
+                                              self.config['telegram_group_rate_limit'])) \
             .build()
 
-        application.add_handler(CommandHandler('reset', self.reset))
+        application.add_handler(CommandHandler('reset', self.serialised(self.reset)))
         application.add_handler(CommandHandler('help', self.help))
         application.add_handler(CommandHandler('image', self.image))
         application.add_handler(CommandHandler('tts', self.tts))
         application.add_handler(CommandHandler('start', self.help))
         application.add_handler(CommandHandler('stats', self.stats))
-        application.add_handler(CommandHandler('resend', self.resend))
+        application.add_handler(CommandHandler('resend', self.serialised(self.resend)))
         application.add_handler(CommandHandler(
-            'chat', self.prompt, filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
+            'chat', self.serialised(self.prompt), filters=filters.ChatType.GROUP | filters.ChatType.SUPERGROUP)
         )
         application.add_handler(MessageHandler(
             filters.PHOTO | filters.Document.IMAGE,
-            self.vision))
+            self.serialised(self.vision)))
         application.add_handler(MessageHandler(
             filters.AUDIO | filters.VOICE | filters.Document.AUDIO |
             filters.VIDEO | filters.VIDEO_NOTE | filters.Document.VIDEO,
-            self.transcribe))
-        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.prompt))
+            self.serialised(self.transcribe)))
+        application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.serialised(self.prompt)))
         application.add_handler(InlineQueryHandler(self.inline_query, chat_types=[
             constants.ChatType.GROUP, constants.ChatType.SUPERGROUP, constants.ChatType.PRIVATE
         ]))
-        application.add_handler(CallbackQueryHandler(self.handle_callback_inline_query))
+        application.add_handler(CallbackQueryHandler(self.serialised(self.handle_callback_inline_query)))
+        application.add_handler(ChatMemberHandler(self.chat_member_updated, ChatMemberHandler.ANY_CHAT_MEMBER))
 
         application.add_error_handler(error_handler)
 
-        application.run_polling()
+        return application
+
+
+def run_application(application: Application, config: dict):
+    """
+    Runs the application indefinitely until the user presses Ctrl+C, polling for updates
+    or receiving them on a webhook if a webhook URL is configured.
+    :param application: The application to run
+    :param config: The Telegram configuration
+    """
+    if config['webhook_url']:
+        run_webhook(application, config)
+    else:
+        # Chat member updates are not sent by default
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+def run_webhook(application: Application, config: dict):
+    """
+    Receives updates on a webhook instead of polling for them. Telegram is told to send
+    updates to the webhook URL, which must reach the server listening on the configured
+    address, port and path (e.g. through a reverse proxy).
+    :param application: The application to run
+    :param config: The Telegram configuration
+    """
+    path = config['webhook_path'].strip('/')
+    webhook_url = config['webhook_url'].rstrip('/')
+    if path:
+        webhook_url = f'{webhook_url}/{path}'
+    if not config['webhook_secret_token']:
+        logging.warning('WEBHOOK_SECRET_TOKEN is not set, anyone who knows the webhook URL can send updates')
+
+    logging.info(f'Listening for updates on {config["webhook_listen"]}:{config["webhook_port"]}/{path}')
+    application.run_webhook(
+        listen=config['webhook_listen'],
+        port=config['webhook_port'],
+        url_path=path,
+        webhook_url=webhook_url,
+        secret_token=config['webhook_secret_token'] or None,
+        max_connections=config['webhook_max_connections'],
+        allowed_updates=Update.ALL_TYPES,
+    )
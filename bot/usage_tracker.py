@@ -1,7 +1,13 @@
+from __future__ import annotations
+
+import asyncio
+import logging
 import os.path
 import pathlib
 import json
-from datetime import date
+import sqlite3
+import threading
+from datetime import date, timedelta
 
 
 def year_month(date_str):
@@ -9,11 +15,76 @@ def year_month(date_str):
     return str(date_str)[:7]
 
 
+def write_file_atomically(path, data):
+    """Writes a file through a temporary file renamed over it, so that it is never left half written.
+
+    :param path: path of the file
+    :param data: new contents of the file
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as outfile:
+        outfile.write(data)
+    os.replace(temp_path, path)
+
+
+async def flush_usage(trackers) -> int:
+    """Writes the user files of the trackers whose usage has changed, in one batch off the event loop.
+    Trackers that fail to be written are written again at the next flush.
+
+    :param trackers: the usage trackers to flush
+    :return: number of user files written
+    """
+    dirty = [tracker for tracker in trackers if tracker.dirty]
+    if not dirty:
+        return 0
+    # serialize on the event loop, where the usage cannot change while it is being serialized
+    snapshots = [(tracker, tracker.user_file, tracker.snapshot()) for tracker in dirty]
+
+    def write_all():
+        failed = []
+        for tracker, path, data in snapshots:
+            try:
+                write_file_atomically(path, data)
+            except OSError as e:
+                logging.warning(f'Failed to write usage file {path}: {str(e)}')
+                failed.append(tracker)
+        return failed
+
+    failed = await asyncio.get_running_loop().run_in_executor(None, write_all)
+    for tracker in failed:
+        tracker.dirty = True
+    return len(snapshots) - len(failed)
+
+
+def backfill_all_time_costs(logs_dir="usage_logs"):
+    """Calculates and saves the all-time cost of the usage logs that do not have it yet,
+    so that it is not calculated from the whole history when their users are first seen.
+
+    :param logs_dir: path to directory of usage logs, defaults to "usage_logs"
+    :return: number of usage logs updated
+    """
+    if not os.path.isdir(logs_dir):
+        return 0
+    updated = 0
+    for file in os.listdir(logs_dir):
+        if not file.endswith(".json"):
+            continue
+        tracker = UsageTracker(file[:-len(".json")], None, logs_dir)
+        if "all_time" not in tracker.usage["current_cost"]:
+            tracker.get_all_time_cost()
+            tracker.save()
+            updated += 1
+    if updated:
+        logging.info(f'Calculated the all-time cost of {updated} usage logs')
+    return updated
+
+
 class UsageTracker:
     """
     UsageTracker class
     Enables tracking of daily/monthly usage per user.
     User files are stored as JSON in /usage_logs directory.
+    Changes are kept in memory and written in batches by flush_usage().
     JSON example:
     {
         "user_name": "@user_name",
@@ -52,6 +123,10 @@ class UsageTracker:
         self.logs_dir = logs_dir
         # path to usage file of given user
         self.user_file = f"{logs_dir}/{user_id}.json"
+        # whether the usage has changed since it was last written to the user file
+        self.dirty = False
+        # incremented whenever a cost is added, so that decisions based on the costs can be invalidated
+        self.version = 0
 
         if os.path.isfile(self.user_file):
             with open(self.user_file, "r") as file:
@@ -70,6 +145,46 @@ class UsageTracker:
                 "usage_history": {"chat_tokens": {}, "transcription_seconds": {}, "number_images": {}, "tts_characters": {}, "vision_tokens":{}}
             }
 
+        # running totals of the usage history per day and per month, so that current usage is a lookup,
+        # eg: {"chat_tokens": {"2023-03-13": 520, "2023-03-14": 1532, "2023-03": 2052}}
+        self.totals = {metric: {} for metric in
+                       ("chat_tokens", "transcription_seconds", "number_images", "tts_characters", "vision_tokens")}
+        history = self.usage["usage_history"]
+        for metric in ("chat_tokens", "transcription_seconds", "vision_tokens"):
+            for day, amount in history.get(metric, {}).items():
+                self.__add_to_totals(metric, day, amount)
+        for day, images in history.get("number_images", {}).items():
+            self.__add_to_totals("number_images", day, sum(images))
+        for characters in history.get("tts_characters", {}).values():
+            for day, amount in characters.items():
+                self.__add_to_totals("tts_characters", day, amount)
+
+    def __add_to_totals(self, metric, day, amount):
+        """Adds usage to the running totals of its day and month."""
+        totals = self.totals[metric]
+        totals[day] = totals.get(day, 0) + amount
+        month = year_month(day)
+        totals[month] = totals.get(month, 0) + amount
+
+    def __current_totals(self, metric):
+        """Get the usage of a metric for today and this month."""
+        today = str(date.today())
+        totals = self.totals[metric]
+        return totals.get(today, 0), totals.get(year_month(today), 0)
+
+    def snapshot(self) -> str:
+        """Serializes the usage to be written to the user file and marks it as saved.
+
+        :return: the usage as JSON
+        """
+        self.dirty = False
+        return json.dumps(self.usage)
+
+    def save(self):
+        """Writes the usage to the user file if it has changed since it was last written."""
+        if self.dirty:
+            write_file_atomically(self.user_file, self.snapshot())
+
     # token usage functions:
 
     def add_chat_tokens(self, tokens, tokens_price=0.002):
@@ -88,27 +203,16 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["chat_tokens"][str(today)] = tokens
+        self.__add_to_totals("chat_tokens", str(today), tokens)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.dirty = True
 
     def get_current_token_usage(self):
         """Get token amounts used for today and this month
 
         :return: total number of tokens used per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["chat_tokens"]:
-            usage_day = self.usage["usage_history"]["chat_tokens"][str(today)]
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, tokens in self.usage["usage_history"]["chat_tokens"].items():
-            if today.startswith(month):
-                usage_month += tokens
-        return usage_day, usage_month
+        return self.__current_totals("chat_tokens")
 
     # image usage functions:
 
@@ -133,27 +237,16 @@ class UsageTracker:
             # create new entry for current date
             self.usage["usage_history"]["number_images"][str(today)] = [0, 0, 0]
             self.usage["usage_history"]["number_images"][str(today)][requested_size] += 1
+        self.__add_to_totals("number_images", str(today), 1)
 
-        # write updated image number to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.dirty = True
 
     def get_current_image_count(self):
         """Get number of images requested for today and this month.
 
         :return: total number of images requested per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["number_images"]:
-            usage_day = sum(self.usage["usage_history"]["number_images"][str(today)])
-        else:
-            usage_day = 0
-        month = str(today)[:7]  # year-month as string
-        usage_month = 0
-        for today, images in self.usage["usage_history"]["number_images"].items():
-            if today.startswith(month):
-                usage_month += sum(images)
-        return usage_day, usage_month
+        return self.__current_totals("number_images")
 
 
     # vision usage functions
@@ -174,27 +267,16 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["vision_tokens"][str(today)] = tokens
+        self.__add_to_totals("vision_tokens", str(today), tokens)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.dirty = True
 
     def get_current_vision_tokens(self):
         """Get vision tokens for today and this month.
 
         :return: total amount of vision tokens per day and per month
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["vision_tokens"]:
-            tokens_day = self.usage["usage_history"]["vision_tokens"][str(today)]
-        else:
-            tokens_day = 0
-        month = str(today)[:7]  # year-month as string
-        tokens_month = 0
-        for today, tokens in self.usage["usage_history"]["vision_tokens"].items():
-            if today.startswith(month):
-                tokens_month += tokens
-        return tokens_day, tokens_month
+        return self.__current_totals("vision_tokens")
 
     # tts usage functions:
 
@@ -218,32 +300,16 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["tts_characters"][tts_model][str(today)] = text_length
+        self.__add_to_totals("tts_characters", str(today), text_length)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.dirty = True
 
     def get_current_tts_usage(self):
         """Get length of speech generated for today and this month.
 
         :return: total amount of characters converted to speech per day and per month
         """
-
-        tts_models = ['tts-1', 'tts-1-hd']
-        today = date.today()
-        characters_day = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"] and \
-                str(today) in self.usage["usage_history"]["tts_characters"][tts_model]:
-                characters_day += self.usage["usage_history"]["tts_characters"][tts_model][str(today)]
-
-        month = str(today)[:7]  # year-month as string
-        characters_month = 0
-        for tts_model in tts_models:
-            if tts_model in self.usage["usage_history"]["tts_characters"]: 
-                for today, characters in self.usage["usage_history"]["tts_characters"][tts_model].items():
-                    if today.startswith(month):
-                        characters_month += characters
+        characters_day, characters_month = self.__current_totals("tts_characters")
         return int(characters_day), int(characters_month)
 
 
@@ -265,21 +331,19 @@ class UsageTracker:
         else:
             # create new entry for current date
             self.usage["usage_history"]["transcription_seconds"][str(today)] = seconds
+        self.__add_to_totals("transcription_seconds", str(today), seconds)
 
-        # write updated token usage to user file
-        with open(self.user_file, "w") as outfile:
-            json.dump(self.usage, outfile)
+        self.dirty = True
 
     def add_current_costs(self, request_cost):
         """
         Add current cost to all_time, day and month cost and update last_update date.
         """
+        self.version += 1
         today = date.today()
         last_update = date.fromisoformat(self.usage["current_cost"]["last_update"])
 
-        # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        self.usage["current_cost"]["all_time"] = \
-            self.usage["current_cost"].get("all_time", self.initialize_all_time_cost()) + request_cost
+        self.usage["current_cost"]["all_time"] = self.get_all_time_cost() + request_cost
         # add current cost, update new day
         if today == last_update:
             self.usage["current_cost"]["day"] += request_cost
@@ -297,16 +361,7 @@ class UsageTracker:
 
         :return: total amount of time transcribed per day and per month (4 values)
         """
-        today = date.today()
-        if str(today) in self.usage["usage_history"]["transcription_seconds"]:
-            seconds_day = self.usage["usage_history"]["transcription_seconds"][str(today)]
-        else:
-            seconds_day = 0
-        month = str(today)[:7]  # year-month as string
-        seconds_month = 0
-        for today, seconds in self.usage["usage_history"]["transcription_seconds"].items():
-            if today.startswith(month):
-                seconds_month += seconds
+        seconds_day, seconds_month = self.__current_totals("transcription_seconds")
         minutes_day, seconds_day = divmod(seconds_day, 60)
         minutes_month, seconds_month = divmod(seconds_month, 60)
         return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
@@ -328,9 +383,18 @@ class UsageTracker:
                 cost_month = self.usage["current_cost"]["month"]
             else:
                 cost_month = 0.0
-        # add to all_time cost, initialize with calculation of total_cost if key doesn't exist
-        cost_all_time = self.usage["current_cost"].get("all_time", self.initialize_all_time_cost())
-        return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
+        return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": self.get_all_time_cost()}
+
+    def get_all_time_cost(self):
+        """Get total USD amount of all requests, calculated from the usage history
+        the first time if the usage log does not have it yet.
+
+        :return: total cost of all requests
+        """
+        if "all_time" not in self.usage["current_cost"]:
+            self.usage["current_cost"]["all_time"] = self.initialize_all_time_cost()
+            self.dirty = True
+        return self.usage["current_cost"]["all_time"]
 
     def initialize_all_time_cost(self, tokens_price=0.002, image_prices="0.016,0.018,0.02", minute_price=0.006, vision_token_price=0.01, tts_prices='0.015,0.030'):
         """Get total USD amount of all requests in history
@@ -362,3 +426,437 @@ class UsageTracker:
 
         all_time_cost = token_cost + transcription_cost + image_cost + vision_cost + tts_cost
         return all_time_cost
+
+
+# Metrics of the SQLite usage ledger. Image and speech metrics are suffixed with the size or model
+METRIC_CHAT_TOKENS = 'chat_tokens'
+METRIC_TRANSCRIPTION_SECONDS = 'transcription_seconds'
+METRIC_VISION_TOKENS = 'vision_tokens'
+METRIC_IMAGES = 'images'
+METRIC_TTS_CHARACTERS = 'tts_characters'
+METRIC_COST = 'cost'
+
+IMAGE_SIZES = ["256x256", "512x512", "1024x1024"]
+
+# seconds to wait for another process writing to a shared database, e.g. the first worker importing the JSON logs
+SHARED_DB_TIMEOUT = 60
+TTS_MODELS = ['tts-1', 'tts-1-hd']
+
+
+def month_range(day):
+    """Get the first and last possible date strings of the month of a date, for range queries.
+
+    :param day: date in the month
+    :return: first and last date strings of the month, e.g. ('2023-03-01', '2023-03-31')
+    """
+    month = year_month(day)
+    return f"{month}-01", f"{month}-31"
+
+
+class SQLiteUsageLedger:
+    """
+    Stores the usage of all users in a single SQLite database, with one row per user, metric and day,
+    so that day, month and all-time totals are indexed range queries.
+    Recorded usage is buffered in memory and written in batches by flush(), which can run in another thread.
+    The day, month and all-time totals of all users are loaded when the database is opened and kept in memory,
+    so reading them does not query the database. When the database is shared, flush() also refreshes them
+    with the usage recorded by the other processes. The existing JSON usage logs are imported the first time the database is opened.
+    """
+
+    def __init__(self, path, logs_dir="usage_logs", shared=False):
+        """
+        :param path: path to the SQLite database file
+        :param logs_dir: path to the directory of the JSON usage logs to import
+        :param shared: whether other processes record usage in the same database, e.g. the other workers
+        """
+        self.shared = shared
+        if shared:
+            # let readers and a writer of other processes work at the same time, and wait for the other writers
+            self.db = sqlite3.connect(path, timeout=SHARED_DB_TIMEOUT, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+        else:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+        # serializes the use of the connection between the event loop and the flushing thread
+        self.db_lock = threading.Lock()
+        # guards the buffered usage, which is recorded on the event loop
+        self.lock = threading.Lock()
+        self.pending = {}  # {user_id: {(metric, date): amount}}
+        self.pending_names = {}  # {user_id: user_name}
+        self.__create_schema(logs_dir)
+        # guarded by lock as well
+        self.totals_day = str(date.today())
+        self.totals = self.__query_totals(self.totals_day)  # {user_id: {metric: [day, month, all-time total]}}
+
+    def __create_schema(self, logs_dir):
+        with self.db_lock:
+            # take the write lock first, so that only one process creates the schema and imports the logs
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if self.db.execute('PRAGMA user_version').fetchone()[0] == 0:
+                    self.db.execute('CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, user_name TEXT)')
+                    self.db.execute('CREATE TABLE IF NOT EXISTS usage (user_id TEXT NOT NULL, metric TEXT NOT NULL, '
+                                    'date TEXT NOT NULL, amount REAL NOT NULL, PRIMARY KEY (user_id, metric, date))'
+                                    ' WITHOUT ROWID')
+                    self.__import_json_logs(logs_dir)
+                    self.db.execute('PRAGMA user_version = 1')
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+
+    def __import_json_logs(self, logs_dir):
+        """
+        Imports the JSON usage logs. Their costs are only known per day, month and all time, so the
+        cost of the current month before its last update is recorded on its first day, and the cost
+        of the previous months on the last day of the previous month.
+        """
+        if not os.path.isdir(logs_dir):
+            return
+        files = [file for file in os.listdir(logs_dir) if file.endswith(".json")]
+        for file in files:
+            user_id = file[:-len(".json")]
+            tracker = UsageTracker(user_id, None, logs_dir)
+            history = tracker.usage["usage_history"]
+            rows = {}
+
+            def add(metric, day, amount):
+                if amount:
+                    rows[(metric, day)] = rows.get((metric, day), 0) + amount
+
+            for metric in (METRIC_CHAT_TOKENS, METRIC_TRANSCRIPTION_SECONDS, METRIC_VISION_TOKENS):
+                for day, amount in history.get(metric, {}).items():
+                    add(metric, day, amount)
+            for day, counts in history.get("number_images", {}).items():
+                for size, count in zip(IMAGE_SIZES, counts):
+                    add(f"{METRIC_IMAGES}:{size}", day, count)
+            for tts_model, characters in history.get("tts_characters", {}).items():
+                for day, amount in characters.items():
+                    add(f"{METRIC_TTS_CHARACTERS}:{tts_model}", day, amount)
+
+            cost = tracker.usage["current_cost"]
+            month_start = date.fromisoformat(month_range(cost["last_update"])[0])
+            all_time = tracker.get_all_time_cost()
+            add(METRIC_COST, cost["last_update"], cost["day"])
+            add(METRIC_COST, str(month_start), cost["month"] - cost["day"])
+            add(METRIC_COST, str(month_start - timedelta(days=1)), all_time - cost["month"])
+
+            self.db.execute('INSERT OR REPLACE INTO users (user_id, user_name) VALUES (?, ?)',
+                            (user_id, tracker.usage.get("user_name")))
+            self.db.executemany('INSERT INTO usage (user_id, metric, date, amount) VALUES (?, ?, ?, ?)',
+                                [(user_id, metric, day, amount) for (metric, day), amount in rows.items()])
+        if files:
+            logging.info(f'Imported the usage logs of {len(files)} users from {logs_dir}')
+
+    def add(self, user_id, user_name, metric, amount, day):
+        """Records usage, to be written at the next flush.
+
+        :param user_id: Telegram ID of the user
+        :param user_name: Telegram user name
+        :param metric: the metric of the usage
+        :param amount: the amount used
+        :param day: date string of the usage
+        """
+        with self.lock:
+            amounts = self.pending.setdefault(str(user_id), {})
+            amounts[(metric, day)] = amounts.get((metric, day), 0) + amount
+            self.pending_names[str(user_id)] = user_name
+            self.__roll_totals()
+            self.__add_to_totals(self.totals.setdefault(str(user_id), {}), metric, day, amount)
+
+    def current_totals(self, user_id, metric):
+        """Get the totals of a metric used by a user, including the usage not written yet.
+
+        :param user_id: Telegram ID of the user
+        :param metric: the metric of the usage
+        :return: total amount used today, this month and all time
+        """
+        with self.lock:
+            self.__roll_totals()
+            day, month, all_time = self.totals.get(str(user_id), {}).get(metric, (0, 0, 0))
+            return day, month, all_time
+
+    def __roll_totals(self):
+        """Starts the day totals over when the day changed, and the month totals when the month changed.
+        Must be called with lock held.
+        """
+        today = str(date.today())
+        if today == self.totals_day:
+            return
+        new_month = year_month(today) != year_month(self.totals_day)
+        for metrics in self.totals.values():
+            for amounts in metrics.values():
+                amounts[0] = 0
+                if new_month:
+                    amounts[1] = 0
+        self.totals_day = today
+
+    def __add_to_totals(self, metrics, metric, day, amount):
+        amounts = metrics.setdefault(metric, [0, 0, 0])
+        if day == self.totals_day:
+            amounts[0] += amount
+        if year_month(day) == year_month(self.totals_day):
+            amounts[1] += amount
+        amounts[2] += amount
+
+    def __with_pending(self, user_id, stored):
+        """Adds the usage of a user that is not written yet to the stored totals of the user.
+        Must be called with lock held.
+        """
+        for (metric, day), amount in self.pending.get(user_id, {}).items():
+            self.__add_to_totals(stored, metric, day, amount)
+
+    def __query_totals(self, today):
+        """Queries the stored day, month and all-time totals of all users. Must be called with db_lock held,
+        or before the ledger is in use.
+
+        :param today: date string of the day of the totals
+        :return: {user_id: {metric: [day total, month total, all-time total]}}
+        """
+        totals = {}
+        month_start, month_end = month_range(today)
+        rows = self.db.execute('SELECT user_id, metric, SUM(CASE WHEN date = ? THEN amount ELSE 0 END), '
+                               'SUM(CASE WHEN date BETWEEN ? AND ? THEN amount ELSE 0 END), SUM(amount) '
+                               'FROM usage GROUP BY user_id, metric',
+                               (today, month_start, month_end))
+        for user_id, metric, day, month, all_time in rows:
+            totals.setdefault(user_id, {})[metric] = [day, month, all_time]
+        return totals
+
+    def flush(self):
+        """Writes the buffered usage in one transaction, then refreshes the totals in memory if the database
+        is shared. Can run in another thread than the one recording usage.
+
+        :return: number of rows written
+        """
+        with self.db_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                names, self.pending_names = self.pending_names, {}
+            rows = [(user_id, metric, day, amount)
+                    for user_id, amounts in pending.items() for (metric, day), amount in amounts.items()]
+            if rows:
+                try:
+                    with self.db:
+                        self.db.executemany('INSERT INTO users (user_id, user_name) VALUES (?, ?) '
+                                            'ON CONFLICT (user_id) DO UPDATE SET user_name = excluded.user_name',
+                                            list(names.items()))
+                        self.db.executemany('INSERT INTO usage (user_id, metric, date, amount) VALUES (?, ?, ?, ?) '
+                                            'ON CONFLICT (user_id, metric, date) DO UPDATE SET amount = amount + excluded.amount',
+                                            rows)
+                except sqlite3.Error:
+                    # keep the usage for the next flush
+                    with self.lock:
+                        for user_id, amounts in pending.items():
+                            merged = self.pending.setdefault(user_id, {})
+                            for key, amount in amounts.items():
+                                merged[key] = merged.get(key, 0) + amount
+                        for user_id, user_name in names.items():
+                            self.pending_names.setdefault(user_id, user_name)
+                    raise
+            if self.shared:
+                self.__refresh_totals()
+            return len(rows)
+
+    def __refresh_totals(self):
+        """Reloads the totals in memory, including the usage recorded by the other processes.
+        Must be called with db_lock held.
+        """
+        today = str(date.today())
+        stored = self.__query_totals(today)
+        with self.lock:
+            self.__roll_totals()
+            if today != self.totals_day:
+                # refreshed at the next flush
+                return
+            for user_id in self.pending:
+                self.__with_pending(user_id, stored.setdefault(user_id, {}))
+            self.totals = stored
+
+    def close(self):
+        self.flush()
+        with self.db_lock:
+            self.db.close()
+
+
+class SQLiteUsageTracker:
+    """
+    Tracks the usage of a user in a SQLiteUsageLedger, with the same API as UsageTracker.
+    The current usage and costs are read from the totals the ledger keeps in memory,
+    so budget checks and /stats do not query the database.
+    """
+
+    def __init__(self, user_id, user_name, ledger):
+        """
+        Initializes the tracker for a user.
+        :param user_id: Telegram ID of the user
+        :param user_name: Telegram user name
+        :param ledger: the ledger storing the usage
+        """
+        self.user_id = user_id
+        self.user_name = user_name
+        self.ledger = ledger
+        # incremented whenever a cost is added, so that decisions based on the costs can be invalidated
+        self.version = 0
+
+    def __add(self, metric, amount, cost):
+        self.ledger.add(self.user_id, self.user_name, metric, amount, str(date.today()))
+        self.add_current_costs(cost)
+
+    def __current_usage(self, metric):
+        """Get the usage of a metric for today and this month."""
+        day, month, _ = self.ledger.current_totals(self.user_id, metric)
+        return day, month
+
+    def add_chat_tokens(self, tokens, tokens_price=0.002):
+        """Adds used tokens from a request to a users usage history and updates current cost
+        :param tokens: total tokens used in last request
+        :param tokens_price: price per 1000 tokens, defaults to 0.002
+        """
+        self.__add(METRIC_CHAT_TOKENS, tokens, round(float(tokens) * tokens_price / 1000, 6))
+
+    def get_current_token_usage(self):
+        """Get token amounts used for today and this month
+
+        :return: total number of tokens used per day and per month
+        """
+        usage_day, usage_month = self.__current_usage(METRIC_CHAT_TOKENS)
+        return int(usage_day), int(usage_month)
+
+    def add_image_request(self, image_size, image_prices="0.016,0.018,0.02"):
+        """Add image request to users usage history and update current costs.
+
+        :param image_size: requested image size
+        :param image_prices: prices for images of sizes ["256x256", "512x512", "1024x1024"],
+                             defaults to [0.016, 0.018, 0.02]
+        """
+        self.__add(f"{METRIC_IMAGES}:{image_size}", 1, image_prices[IMAGE_SIZES.index(image_size)])
+
+    def get_current_image_count(self):
+        """Get number of images requested for today and this month.
+
+        :return: total number of images requested per day and per month
+        """
+        counts = [self.__current_usage(f"{METRIC_IMAGES}:{size}") for size in IMAGE_SIZES]
+        return int(sum(day for day, _ in counts)), int(sum(month for _, month in counts))
+
+    def add_vision_tokens(self, tokens, vision_token_price=0.01):
+        """
+         Adds requested vision tokens to a users usage history and updates current cost.
+        :param tokens: total tokens used in last request
+        :param vision_token_price: price per 1K tokens transcription, defaults to 0.01
+        """
+        self.__add(METRIC_VISION_TOKENS, tokens, round(tokens * vision_token_price / 1000, 2))
+
+    def get_current_vision_tokens(self):
+        """Get vision tokens for today and this month.
+
+        :return: total amount of vision tokens per day and per month
+        """
+        tokens_day, tokens_month = self.__current_usage(METRIC_VISION_TOKENS)
+        return int(tokens_day), int(tokens_month)
+
+    def add_tts_request(self, text_length, tts_model, tts_prices):
+        price = tts_prices[TTS_MODELS.index(tts_model)]
+        self.__add(f"{METRIC_TTS_CHARACTERS}:{tts_model}", text_length, round(text_length * price / 1000, 2))
+
+    def get_current_tts_usage(self):
+        """Get length of speech generated for today and this month.
+
+        :return: total amount of characters converted to speech per day and per month
+        """
+        counts = [self.__current_usage(f"{METRIC_TTS_CHARACTERS}:{tts_model}") for tts_model in TTS_MODELS]
+        return int(sum(day for day, _ in counts)), int(sum(month for _, month in counts))
+
+    def add_transcription_seconds(self, seconds, minute_price=0.006):
+        """Adds requested transcription seconds to a users usage history and updates current cost.
+        :param seconds: total seconds used in last request
+        :param minute_price: price per minute transcription, defaults to 0.006
+        """
+        self.__add(METRIC_TRANSCRIPTION_SECONDS, seconds, round(seconds * minute_price / 60, 2))
+
+    def get_current_transcription_duration(self):
+        """Get minutes and seconds of audio transcribed for today and this month.
+
+        :return: total amount of time transcribed per day and per month (4 values)
+        """
+        seconds_day, seconds_month = self.__current_usage(METRIC_TRANSCRIPTION_SECONDS)
+        minutes_day, seconds_day = divmod(seconds_day, 60)
+        minutes_month, seconds_month = divmod(seconds_month, 60)
+        return int(minutes_day), round(seconds_day, 2), int(minutes_month), round(seconds_month, 2)
+
+    def add_current_costs(self, request_cost):
+        """
+        Add current cost to all_time, day and month cost.
+        """
+        self.version += 1
+        self.ledger.add(self.user_id, self.user_name, METRIC_COST, request_cost, str(date.today()))
+
+    def get_current_cost(self):
+        """Get total USD amount of all requests of the current day and month
+
+        :return: cost of current day and month
+        """
+        cost_day, cost_month, cost_all_time = self.ledger.current_totals(self.user_id, METRIC_COST)
+        return {"cost_today": cost_day, "cost_month": cost_month, "cost_all_time": cost_all_time}
+
+
+class UsageTrackers(dict):
+    """
+    The usage trackers of the users by user ID, created on first use and kept in memory.
+    Their changes are written in batches by flush(), to the JSON usage logs or to a SQLite ledger.
+    """
+
+    def __init__(self, ledger=None, logs_dir="usage_logs"):
+        """
+        :param ledger: the SQLite ledger to store the usage in, or None to use JSON usage logs
+        :param logs_dir: path to directory of the JSON usage logs
+        """
+        super().__init__()
+        self.ledger = ledger
+        self.logs_dir = logs_dir
+
+    def tracker(self, user_id, user_name):
+        """Get the usage tracker of a user, creating it if needed.
+
+        :param user_id: Telegram ID of the user
+        :param user_name: Telegram user name
+        :return: the usage tracker
+        """
+        if user_id not in self:
+            if self.ledger is not None:
+                self[user_id] = SQLiteUsageTracker(user_id, user_name, self.ledger)
+            else:
+                self[user_id] = UsageTracker(user_id, user_name, self.logs_dir)
+        return self[user_id]
+
+    async def flush(self):
+        """Writes the changed usage, off the event loop.
+
+        :return: number of user files or ledger rows written
+        """
+        if self.ledger is not None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.ledger.flush)
+        return await flush_usage(list(self.values()))
+
+    def close(self):
+        """Writes the changed usage before shutting down."""
+        if self.ledger is not None:
+            self.ledger.close()
+            return
+        for tracker in self.values():
+            try:
+                tracker.save()
+            except OSError as e:
+                logging.error(f'Failed to write usage file {tracker.user_file}: {str(e)}')
+
+
+def create_usage_trackers(config):
+    """Creates the usage trackers with the storage described by the given configuration.
+
+    :param config: a dictionary containing the Telegram configuration
+    :return: the usage trackers
+    """
+    if config['usage_store'] == 'sqlite':
+        # With several workers, each one sees the usage recorded by the others through the database
+        return UsageTrackers(SQLiteUsageLedger(config['usage_db_path'], shared=config['workers'] > 1))
+    return UsageTrackers()
@@ -6,12 +6,21 @@ import json
 import logging
 import os
 import base64
+import re
 
 import telegram
 from telegram import Message, MessageEntity, Update, ChatMember, constants
 from telegram.ext import CallbackContext, ContextTypes
 
-from usage_tracker import UsageTracker
+from group_membership import GroupMembershipCache
+from usage_tracker import UsageTrackers
+from rate_limiter import PRIORITY_INTERMEDIATE
+
+# Closes a code block cut at the end of a chunk
+CLOSING_FENCE = '\n```'
+# A line opening or closing a code block, with the language of the block if any. The language is
+# limited so that reopening the block fits in the room split_into_chunks leaves for it
+CODE_FENCE = re.compile(r'^\s*```([\w+-]{0,32})\s*$')
 
 
 def message_text(message: Message) -> str:
@@ -54,16 +63,14 @@ def get_thread_id(update: Update) -> int | None:
     return None
 
 
-def get_stream_cutoff_values(update: Update, content: str) -> int:
+def get_stream_edit_interval(config, update: Update) -> float:
     """
-    Gets the stream cutoff values for the message length
+    Gets the minimum number of seconds between two edits of a streamed message
     """
     if is_group_chat(update):
         # group chats have stricter flood limits
-        return 180 if len(content) > 1000 else 120 if len(content) > 200 \
-            else 90 if len(content) > 50 else 50
-    return 90 if len(content) > 1000 else 45 if len(content) > 200 \
-        else 25 if len(content) > 50 else 15
+        return config['stream_group_edit_interval']
+    return config['stream_edit_interval']
 
 
 def is_group_chat(update: Update) -> bool:
@@ -78,11 +85,141 @@ def is_group_chat(update: Update) -> bool:
     ]
 
 
-def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
+def utf16_length(text: str) -> int:
     """
-    Splits a string into chunks of a given size.
+    Gets the length of a string in UTF-16 code units, the way Telegram measures message length
     """
-    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+    return len(text.encode('utf-16-le')) // 2
+
+
+def split_into_chunks(text: str, chunk_size: int = 4096) -> list[str]:
+    """
+    Splits a string into chunks of at most the given size in UTF-16 code units.
+    Chunks end at paragraph or line boundaries where possible, and code blocks
+    cut between two chunks are closed and reopened so each chunk is valid markdown.
+    """
+    chunks, lines, line_starts = split_lines_into_chunks(text, chunk_size)
+    last_chunk = format_chunk(''.join(lines), open_code_fence(lines, line_starts, complete=True))
+    if len(last_chunk.strip()) > 0:
+        chunks.append(last_chunk)
+    return chunks
+
+
+def split_complete_chunks(text: str, chunk_size: int = 4096) -> tuple[list[str], str]:
+    """
+    Splits a string like split_into_chunks, except for the text after the last complete chunk,
+    which is returned as it is, so that more text can be appended to it and split again.
+    It starts by reopening the code block left open by the last chunk, if any.
+    :return: The complete chunks and the remaining text, which fits in a chunk
+    """
+    chunks, lines, _ = split_lines_into_chunks(text, chunk_size)
+    return chunks, ''.join(lines)
+
+
+def split_lines_into_chunks(text: str, chunk_size: int) -> tuple[list[str], list[str], list[bool]]:
+    """
+    Splits a string into complete chunks, see split_into_chunks.
+    :return: The complete chunks, then the remaining lines and whether each of them starts a line
+             of the text, as opposed to continuing a line longer than a chunk
+    """
+    chunks = []
+    lines = []
+    line_starts = []
+    length = 0
+
+    def flush(count: int):
+        nonlocal lines, line_starts, length
+        fence = open_code_fence(lines[:count], line_starts[:count])
+        chunk = format_chunk(''.join(lines[:count]), fence)
+        if len(chunk.strip()) > 0:
+            chunks.append(chunk)
+        reopened = [fence + '\n'] if fence is not None else []
+        lines = reopened + lines[count:]
+        line_starts = [True] * len(reopened) + line_starts[count:]
+        length = sum(utf16_length(line) for line in lines)
+
+    # Leave room for reopening a code block before a line cut to the chunk size
+    line_start = True
+    for line in split_long_lines(text, max(chunk_size - 64, chunk_size // 2)):
+        line_length = utf16_length(line)
+        if lines and length + line_length + len(CLOSING_FENCE) > chunk_size:
+            flush(paragraph_break(lines, chunk_size // 2))
+            if lines and length + line_length + len(CLOSING_FENCE) > chunk_size:
+                flush(len(lines))
+        lines.append(line)
+        line_starts.append(line_start)
+        line_start = line.endswith('\n')
+        length += line_length
+    return chunks, lines, line_starts
+
+
+def format_chunk(text: str, fence: str | None) -> str:
+    """
+    Strips the line breaks around a chunk and closes the code block left open at its end, if any
+    :param text: The text of the chunk
+    :param fence: The fence of the code block left open at the end of the chunk, if any
+    """
+    chunk = text.strip('\n')
+    if fence is not None:
+        chunk += CLOSING_FENCE
+    return chunk
+
+
+def split_long_lines(text: str, max_length: int) -> list[str]:
+    """
+    Splits a string into lines, keeping the line breaks, and splits lines longer than
+    the given size in UTF-16 code units at the last space before the limit, if any.
+    """
+    lines = []
+    for line in text.splitlines(keepends=True):
+        while utf16_length(line) > max_length:
+            # Step back one code point at a time, so astral characters are never split,
+            # but always keep at least one so that the line gets shorter
+            cut = min(max_length, len(line))
+            length = utf16_length(line[:cut])
+            while length > max_length and cut > 1:
+                cut -= 1
+                length -= utf16_length(line[cut])
+            space = line.rfind(' ', 0, cut)
+            if space > cut // 2:
+                cut = space + 1
+            lines.append(line[:cut])
+            line = line[cut:]
+        if line:
+            lines.append(line)
+    return lines
+
+
+def paragraph_break(lines: list[str], min_length: int) -> int:
+    """
+    Gets the number of lines up to the last paragraph break after at least the given length,
+    or all the lines if there is none.
+    """
+    length = 0
+    best = len(lines)
+    for index, line in enumerate(lines):
+        length += utf16_length(line)
+        if length >= min_length and len(line.strip()) == 0:
+            best = index + 1
+    return best
+
+
+def open_code_fence(lines: list[str], line_starts: list[bool], complete: bool = False) -> str | None:
+    """
+    Gets the fence reopening the code block that is still open at the end of the lines, if any.
+    Only whole lines made of a fence and a language count, not inline code such as ```pip install```
+    nor the pieces of a line longer than a chunk.
+    :param lines: The lines, as split by split_long_lines
+    :param line_starts: Whether each line starts a line of the text, rather than continuing a longer one
+    :param complete: Whether the lines end the text, so that the last one is whole even without a line break
+    """
+    fence = None
+    for index, (line, line_start) in enumerate(zip(lines, line_starts)):
+        whole = line_start and (line.endswith('\n') or (complete and index == len(lines) - 1))
+        match = CODE_FENCE.match(line) if whole else None
+        if match:
+            fence = '```' + match.group(1) if fence is None else None
+    return fence
 
 
 async def wrap_with_indicator(update: Update, context: CallbackContext, coroutine,
@@ -93,8 +230,12 @@ async def wrap_with_indicator(update: Update, context: CallbackContext, coroutin
     task = context.application.create_task(coroutine(), update=update)
     while not task.done():
         if not is_inline:
+            # Chat actions are sent with the lowest priority, and a newer one replaces one still waiting
             context.application.create_task(
-                update.effective_chat.send_action(chat_action, message_thread_id=get_thread_id(update))
+                context.bot.send_chat_action(chat_id=update.effective_chat.id, action=chat_action,
+                                             message_thread_id=get_thread_id(update),
+                                             rate_limit_args={'priority': PRIORITY_INTERMEDIATE,
+                                                              'key': ('action', update.effective_chat.id)})
             )
         try:
             await asyncio.wait_for(asyncio.shield(task), 4.5)
@@ -103,7 +244,8 @@ async def wrap_with_indicator(update: Update, context: CallbackContext, coroutin
 
 
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int | None,
-                                  message_id: str, text: str, markdown: bool = True, is_inline: bool = False):
+                                  message_id: str, text: str, markdown: bool = True, is_inline: bool = False,
+                                  rate_limit_args: dict = None):
     """
     Edit a message with retry logic in case of failure (e.g. broken markdown)
     :param context: The context to use
@@ -112,6 +254,7 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
     :param text: The text to edit the message with
     :param markdown: Whether to use markdown parse mode
     :param is_inline: Whether the message to edit is an inline message
+    :param rate_limit_args: The priority and key of the edit for the rate limiter, if any
     :return: None
     """
     try:
@@ -121,6 +264,7 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
             inline_message_id=message_id if is_inline else None,
             text=text,
             parse_mode=constants.ParseMode.MARKDOWN if markdown else None,
+            rate_limit_args=rate_limit_args,
         )
     except telegram.error.BadRequest as e:
         if str(e).startswith("Message is not modified"):
@@ -131,6 +275,7 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
                 message_id=int(message_id) if not is_inline else None,
                 inline_message_id=message_id if is_inline else None,
                 text=text,
+                rate_limit_args=rate_limit_args,
             )
         except Exception as e:
             logging.warning(f'Failed to edit message: {str(e)}')
@@ -141,6 +286,17 @@ async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: i
         raise e
 
 
+def setup_logging():
+    """
+    Sets up logging for the current process.
+    """
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
 async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles errors in the telegram-python-bot library.
@@ -148,9 +304,11 @@ async def error_handler(_: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(f'Exception while handling an update: {context.error}')
 
 
-async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False) -> bool:
+async def is_allowed(config, update: Update, context: CallbackContext, is_inline=False,
+                     memberships: GroupMembershipCache = None) -> bool:
     """
     Checks if the user is allowed to use the bot.
+    :param memberships: The group membership cache used to check group chats
     """
     if config['allowed_user_ids'] == '*':
         return True
@@ -159,19 +317,18 @@ async def is_allowed(config, update: Update, context: CallbackContext, is_inline
     if is_admin(config, user_id):
         return True
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    allowed_user_ids = config['allowed_user_ids'].split(',')
     # Check if user is allowed
-    if str(user_id) in allowed_user_ids:
+    if str(user_id) in config['allowed_user_id_set']:
         return True
     # Check if it's a group a chat with at least one authorized member
     if not is_inline and is_group_chat(update):
-        admin_user_ids = config['admin_user_ids'].split(',')
-        for user in itertools.chain(allowed_user_ids, admin_user_ids):
-            if not user.strip():
-                continue
-            if await is_user_in_group(update, context, user):
-                logging.info(f'{user} is a member. Allowing group chat message...')
-                return True
+        memberships = memberships or GroupMembershipCache(ttl=0)
+        users = [user for user in config['allowed_user_id_set'] | config['admin_user_id_set'] if user.strip()]
+        member = await memberships.find_member(update.message.chat_id, users,
+                                               lambda user: is_user_in_group(update, context, user))
+        if member is not None:
+            logging.info(f'{member} is a member. Allowing group chat message...')
+            return True
         logging.info(f'Group chat messages from user {name} '
                      f'(id: {user_id}) are not allowed')
     return False
@@ -187,13 +344,8 @@ def is_admin(config, user_id: int, log_no_admin=False) -> bool:
             logging.info('No admin user defined.')
         return False
 
-    admin_user_ids = config['admin_user_ids'].split(',')
-
     # Check if user is in the admin user list
-    if str(user_id) in admin_user_ids:
-        return True
-
-    return False
+    return str(user_id) in config['admin_user_id_set']
 
 
 def get_user_budget(config, user_id) -> float | None:
@@ -208,29 +360,54 @@ def get_user_budget(config, user_id) -> float | None:
     if is_admin(config, user_id) or config['user_budgets'] == '*':
         return float('inf')
 
-    user_budgets = config['user_budgets'].split(',')
     if config['allowed_user_ids'] == '*':
-        # same budget for all users, use value in first position of budget list
-        if len(user_budgets) > 1:
-            logging.warning('multiple values for budgets set with unrestricted user list '
-                            'only the first value is used as budget for everyone.')
-        return float(user_budgets[0])
+        # same budget for all users
+        return config['default_user_budget']
 
+    return config['user_budget_map'].get(str(user_id))
+
+
+def parse_user_lists(config) -> dict:
+    """
+    Parses the comma-separated user ID and budget lists of the bot configuration once,
+    so that checking a user is a set or dict lookup.
+    :param config: The bot configuration object
+    :return: The configuration entries to add: the sets of allowed and admin user IDs,
+             the budget of each allowed user and the budget of all users if everyone is allowed
+    """
     allowed_user_ids = config['allowed_user_ids'].split(',')
-    if str(user_id) in allowed_user_ids:
-        user_index = allowed_user_ids.index(str(user_id))
-        if len(user_budgets) <= user_index:
-            logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
-            return 0.0
-        return float(user_budgets[user_index])
-    return None
+    user_budgets = config['user_budgets'].split(',')
+    default_user_budget = None
+    user_budget_map = {}
+    if config['user_budgets'] != '*':
+        if config['allowed_user_ids'] == '*':
+            # same budget for all users, use value in first position of budget list
+            if len(user_budgets) > 1:
+                logging.warning('multiple values for budgets set with unrestricted user list '
+                                'only the first value is used as budget for everyone.')
+            default_user_budget = float(user_budgets[0])
+        else:
+            for user_id, budget in itertools.zip_longest(allowed_user_ids, user_budgets[:len(allowed_user_ids)]):
+                if user_id in user_budget_map:
+                    # the first budget of a user listed several times is used
+                    continue
+                if budget is None:
+                    logging.warning(f'No budget set for user id: {user_id}. Budget list shorter than user list.')
+                user_budget_map[user_id] = float(budget) if budget is not None else 0.0
+
+    return {
+        'allowed_user_id_set': frozenset(allowed_user_ids),
+        'admin_user_id_set': frozenset(config['admin_user_ids'].split(',')),
+        'user_budget_map': user_budget_map,
+        'default_user_budget': default_user_budget,
+    }
 
 
-def get_remaining_budget(config, usage, update: Update, is_inline=False) -> float:
+def get_remaining_budget(config, usage: UsageTrackers, update: Update, is_inline=False) -> float:
     """
     Calculate the remaining budget for a user based on their current usage.
     :param config: The bot configuration object
-    :param usage: The usage tracker object
+    :param usage: The usage trackers
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: The remaining budget for the user as a float
@@ -244,8 +421,7 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
 
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    usage.tracker(user_id, name)
 
     # Get budget for users
     user_budget = get_user_budget(config, user_id)
@@ -255,34 +431,32 @@ def get_remaining_budget(config, usage, update: Update, is_inline=False) -> floa
         return user_budget - cost
 
     # Get budget for guests
-    if 'guests' not in usage:
-        usage['guests'] = UsageTracker('guests', 'all guest users in group chats')
+    usage.tracker('guests', 'all guest users in group chats')
     cost = usage['guests'].get_current_cost()[budget_cost_map[budget_period]]
     return config['guest_budget'] - cost
 
 
-def is_within_budget(config, usage, update: Update, is_inline=False) -> bool:
+def is_within_budget(config, usage: UsageTrackers, update: Update, is_inline=False) -> bool:
     """
     Checks if the user reached their usage limit.
-    Initializes UsageTracker for user and guest when needed.
+    Initializes the usage trackers of the user and guests when needed.
     :param config: The bot configuration object
-    :param usage: The usage tracker object
+    :param usage: The usage trackers
     :param update: Telegram update object
     :param is_inline: Boolean flag for inline queries
     :return: Boolean indicating if the user has a positive budget
     """
     user_id = update.inline_query.from_user.id if is_inline else update.message.from_user.id
     name = update.inline_query.from_user.name if is_inline else update.message.from_user.name
-    if user_id not in usage:
-        usage[user_id] = UsageTracker(user_id, name)
+    usage.tracker(user_id, name)
     remaining_budget = get_remaining_budget(config, usage, update, is_inline=is_inline)
     return remaining_budget > 0
 
 
-def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
+def add_chat_request_to_usage_tracker(usage: UsageTrackers, config, user_id, used_tokens):
     """
     Add chat request to usage tracker
-    :param usage: The usage tracker object
+    :param usage: The usage trackers
     :param config: The bot configuration object
     :param user_id: The user id
     :param used_tokens: The number of tokens used
@@ -294,8 +468,7 @@ def add_chat_request_to_usage_tracker(usage, config, user_id, used_tokens):
         # add chat request to users usage tracker
         usage[user_id].add_chat_tokens(used_tokens, config['token_price'])
         # add guest chat request to guest usage tracker
-        allowed_user_ids = config['allowed_user_ids'].split(',')
-        if str(user_id) not in allowed_user_ids and 'guests' in usage:
+        if str(user_id) not in config['allowed_user_id_set'] and 'guests' in usage:
             usage["guests"].add_chat_tokens(used_tokens, config['token_price'])
     except Exception as e:
         logging.warning(f'Failed to add tokens to usage_logs: {str(e)}')
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bot modules import each other by their module names, the way main.py runs them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
@@ -0,0 +1,47 @@
+import asyncio
+
+from admission import AdmissionController, AdmittedStream, PRIORITY_PRIVATE
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = False
+
+    async def __anext__(self):
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.closed = True
+
+
+def test_streams_stay_admitted_until_exhausted():
+    async def run():
+        admission = AdmissionController(max_in_flight=1, tokens_per_minute=0)
+        await admission.acquire(10, PRIORITY_PRIVATE)
+        stream = AdmittedStream(FakeStream(['a', 'b']), admission.release)
+        assert [chunk async for chunk in stream] == ['a', 'b']
+        assert admission.in_flight == 0
+        await stream.close()
+        assert admission.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_streams_stay_admitted_until_closed():
+    async def run():
+        admission = AdmissionController(max_in_flight=1, tokens_per_minute=0)
+        await admission.acquire(10, PRIORITY_PRIVATE)
+        stream = AdmittedStream(FakeStream(['a', 'b']), admission.release)
+        assert await stream.__anext__() == 'a'
+        waiting = asyncio.create_task(admission.acquire(10, PRIORITY_PRIVATE))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        await stream.close()
+        await waiting
+        assert stream.stream.closed and admission.in_flight == 1
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import openai_helper
+from conversation_store import Conversation, InMemoryConversationStore
+from openai_helper import OpenAIHelper
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    # Count one token per word instead of downloading the tiktoken encoding
+    monkeypatch.setitem(openai_helper.encodings, 'gpt-4o', SimpleNamespace(encode=str.split))
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        # Let the other requests run while this one is in flight
+        await asyncio.sleep(0.01)
+        message = SimpleNamespace(content='summary')
+        usage = SimpleNamespace(total_tokens=10, prompt_tokens=5, completion_tokens=5)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+def create_helper(**config) -> OpenAIHelper:
+    config = {
+        'api_key': 'test',
+        'model': 'gpt-4o',
+        'max_tokens': 1000,
+        'max_history_size': 10,
+        'history_strategy': 'hybrid',
+        'enable_background_summarisation': True,
+        'background_summarisation_margin': 0.2,
+        'max_concurrent_requests': 10,
+        'tokens_per_minute': 0,
+        'openai_max_retries': 0,
+        'openai_max_retry_wait': 0,
+        'admin_user_id_set': frozenset(),
+        'assistant_prompt': 'You are a helpful assistant.',
+        'max_conversation_age_minutes': 180,
+        'enable_functions': False,
+        'temperature': 1.0,
+        'n_choices': 1,
+        'presence_penalty': 0.0,
+        'frequency_penalty': 0.0,
+        'show_usage': False,
+        'show_plugins_used': False,
+        'bot_language': 'en',
+        **config,
+    }
+    store = InMemoryConversationStore(config.pop('max_conversations', 100), 10 ** 7)
+    helper = OpenAIHelper(config, plugin_manager=None, conversation_store=store)
+    helper.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    return helper
+
+
+def schedule_summary(helper: OpenAIHelper, message_count: int, message_tokens: int):
+    async def run():
+        conversation = Conversation()
+        for _ in range(message_count):
+            conversation.append({'role': 'user', 'content': 'hello'}, message_tokens)
+        helper.conversation_store.put(1, conversation)
+        helper._OpenAIHelper__schedule_background_summary(1)
+        await asyncio.gather(*helper.summary_tasks.values())
+
+    asyncio.run(run())
+    return helper.client.chat.completions.calls
+
+
+def test_hybrid_does_not_summarise_when_only_the_message_count_is_exceeded():
+    assert schedule_summary(create_helper(), message_count=20, message_tokens=5) == 0
+
+
+def test_hybrid_summarises_close_to_the_token_limit():
+    assert schedule_summary(create_helper(), message_count=5, message_tokens=25000) == 1
+
+
+def test_summarise_summarises_when_the_message_count_is_exceeded():
+    assert schedule_summary(create_helper(history_strategy='summarise'), message_count=20, message_tokens=5) == 1
+
+
+def test_conversations_in_flight_are_not_evicted():
+    helper = create_helper(max_conversations=1)
+
+    async def run():
+        return await asyncio.gather(helper.get_chat_response(chat_id=1, query='hello'),
+                                    helper.get_chat_response(chat_id=2, query='hello'))
+
+    assert asyncio.run(run()) == [('summary', 10), ('summary', 10)]
+    assert len(helper.conversation_store.conversations) == 1
+
+
+def test_background_summaries_pin_the_conversation_and_are_cancelled():
+    helper = create_helper(history_strategy='summarise')
+
+    async def run():
+        conversation = Conversation()
+        for _ in range(20):
+            conversation.append({'role': 'user', 'content': 'hello'}, 5)
+        helper.conversation_store.put(1, conversation)
+        helper._OpenAIHelper__schedule_background_summary(1)
+        assert helper.conversation_store.pinned == {1: 1}
+        await helper.cancel_background_summaries()
+
+    asyncio.run(run())
+    assert helper.summary_tasks == {}
+    assert helper.conversation_store.pinned == {}
+
+
+def test_messages_of_unknown_models_are_counted(monkeypatch):
+    monkeypatch.setitem(openai_helper.encodings, 'my-fine-tuned-model', SimpleNamespace(encode=str.split))
+    helper = create_helper(model='my-fine-tuned-model')
+    helper.reset_chat_history(1)
+    assert helper.get_conversation_stats(1)[1] > 0
@@ -0,0 +1,40 @@
+import os
+
+from plugin_manager import PluginManager
+from plugins.pattern_plugin import PatternPlugin
+
+
+def test_patterns_are_rescanned_when_a_system_prompt_is_added_or_removed(tmp_path):
+    plugin = PatternPlugin()
+    plugin.patterns_dir = str(tmp_path)
+    (tmp_path / 'summarize').mkdir()
+    (tmp_path / 'summarize' / 'system.md').write_text('Summarize the input')
+    (tmp_path / 'draft').mkdir()
+    assert plugin.get_available_patterns() == ['summarize']
+
+    (tmp_path / 'draft' / 'system.md').write_text('Draft a reply')
+    # the directory modification times have a coarse resolution on some file systems
+    os.utime(tmp_path / 'draft', ns=(0, 1))
+    assert plugin.get_available_patterns() == ['draft', 'summarize']
+
+    (tmp_path / 'summarize' / 'system.md').unlink()
+    os.utime(tmp_path / 'summarize', ns=(0, 1))
+    assert plugin.get_available_patterns() == ['draft']
+
+
+def test_specs_are_only_replaced_when_the_patterns_change(tmp_path):
+    manager = PluginManager({'plugins': ['pattern']})
+    plugin = manager.plugins[0]
+    plugin.patterns_dir = str(tmp_path)
+    manager.reload()
+    specs = manager.get_functions_specs()
+    assert not manager.specs_changed()
+    manager.reload()
+    assert manager.get_functions_specs() is specs
+
+    (tmp_path / 'summarize').mkdir()
+    (tmp_path / 'summarize' / 'system.md').write_text('Summarize the input')
+    assert manager.specs_changed()
+    manager.reload()
+    assert manager.get_functions_specs() is not specs
+    assert not manager.specs_changed()
@@ -0,0 +1,29 @@
+import asyncio
+import time
+
+from rate_limiter import TelegramRateLimiter
+
+
+def send_requests(endpoint: str, count: int) -> float:
+    async def run():
+        limiter = TelegramRateLimiter(overall_rate=30, group_rate_per_minute=20)
+
+        async def callback():
+            return True
+
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.process_request(callback, (), {}, endpoint, {'chat_id': -100}, None)
+                               for _ in range(count)))
+        await limiter.shutdown()
+        return time.monotonic() - start
+
+    return asyncio.run(run())
+
+
+def test_group_lookups_only_use_the_overall_limit():
+    assert send_requests('getChatMember', 8) < 1
+    assert send_requests('sendChatAction', 8) < 1
+
+
+def test_group_messages_use_the_group_limit():
+    assert send_requests('sendMessage', 4) >= 2
@@ -0,0 +1,32 @@
+from usage_tracker import SQLiteUsageLedger, UsageTrackers
+
+
+def test_sqlite_totals_include_pending_and_stored_usage(tmp_path):
+    trackers = UsageTrackers(SQLiteUsageLedger(str(tmp_path / 'usage.db'), str(tmp_path / 'logs')))
+    tracker = trackers.tracker(1, 'user')
+    tracker.add_chat_tokens(1000, 1.0)
+    trackers.ledger.flush()
+    tracker.add_chat_tokens(500, 1.0)
+    assert tracker.get_current_token_usage() == (1500, 1500)
+    assert tracker.get_current_cost() == {'cost_today': 1.5, 'cost_month': 1.5, 'cost_all_time': 1.5}
+    trackers.close()
+
+    trackers = UsageTrackers(SQLiteUsageLedger(str(tmp_path / 'usage.db'), str(tmp_path / 'logs')))
+    assert trackers.tracker(1, 'user').get_current_cost()['cost_all_time'] == 1.5
+    trackers.close()
+
+
+def test_shared_sqlite_totals_are_refreshed_on_flush(tmp_path):
+    path = str(tmp_path / 'usage.db')
+    first = UsageTrackers(SQLiteUsageLedger(path, str(tmp_path / 'logs'), shared=True))
+    second = UsageTrackers(SQLiteUsageLedger(path, str(tmp_path / 'logs'), shared=True))
+    first.tracker(1, 'user').add_chat_tokens(1000, 1.0)
+    second.tracker(1, 'user').add_chat_tokens(2000, 1.0)
+    first.ledger.flush()
+    assert second.tracker(1, 'user').get_current_cost()['cost_today'] == 2.0
+    second.ledger.flush()
+    assert second.tracker(1, 'user').get_current_cost()['cost_today'] == 3.0
+    first.ledger.flush()
+    assert first.tracker(1, 'user').get_current_cost()['cost_today'] == 3.0
+    first.close()
+    second.close()
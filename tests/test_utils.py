@@ -0,0 +1,50 @@
+from random import Random
+
+from utils import split_into_chunks, split_long_lines, utf16_length
+
+
+def test_split_long_lines_splits_astral_characters():
+    lines = split_long_lines('😀' * 5000, 4032)
+    assert ''.join(lines) == '😀' * 5000
+    assert all(0 < utf16_length(line) <= 4032 for line in lines)
+
+
+def test_split_into_chunks_splits_a_line_of_emoji():
+    chunks = split_into_chunks('😀' * 5000)
+    assert ''.join(chunks) == '😀' * 5000
+    assert all(utf16_length(chunk) <= 4096 for chunk in chunks)
+
+
+def test_split_long_lines_keeps_astral_characters_whole_below_their_width():
+    assert split_long_lines('😀😀', 1) == ['😀', '😀']
+
+
+def test_split_into_chunks_ignores_inline_fences():
+    paragraph = 'plain text ' * 50 + '\n\n'
+    text = '```pip install foo``` installs it.\n\n' + paragraph * 11
+    chunks = split_into_chunks(text)
+    assert len(chunks) > 1
+    assert not any(chunk.endswith('\n```') for chunk in chunks)
+    assert ''.join(chunks).count('```') == 2
+
+
+def test_split_into_chunks_reopens_code_blocks_with_their_language():
+    code = ''.join(f'print({index})\n' for index in range(600))
+    chunks = split_into_chunks('```python title="x"\n' + code + '```\n')
+    # The opener has trailing text, so it is not a fence and nothing is closed or reopened
+    assert not chunks[1].startswith('```')
+    chunks = split_into_chunks('```python\n' + code + '```\n')
+    assert chunks[0].endswith('\n```')
+    assert chunks[1].startswith('```python\n')
+    assert sum(chunk.count('print(') for chunk in chunks) == 600
+
+
+def test_split_into_chunks_keeps_the_text_of_mixed_fences():
+    random = Random(0)
+    parts = ['word ', '```', '```python\n', '```pip y``` ', '\n', '\n\n', 'x' * 50, 'x' * 300, '😀' * 40]
+    for _ in range(300):
+        text = ''.join(random.choice(parts) for _ in range(random.randint(0, 200)))
+        chunk_size = random.choice([100, 300, 4096])
+        chunks = split_into_chunks(text, chunk_size)
+        assert sum(chunk.count('x') for chunk in chunks) == text.count('x')
+        assert all(utf16_length(chunk) <= chunk_size for chunk in chunks)